@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks for django-hstore.
+
+Usage:
+
+    ./benchmarks.py [--settings=settings_psycopg] [benchmark_name ...]
+
+Benchmarks which need the database run against a temporary test database
+created with the same settings used by runtests.py.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, "tests")
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def report(label, rows, seconds):
+    print('    %-40s %12.0f rows/sec' % (label, rows / seconds))
+
+
+def best_of(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def make_row(keys=200):
+    return dict(('key%d' % i, 'value %d' % i) for i in range(keys))
+
+
+@benchmark
+def hstoredict_load(rows=2000, keys=200):
+    """
+    HStoreDict construction from a plain dict vs a dict loaded from the database
+    """
+    from django_hstore.dict import HStoreDict, DatabaseDict
+
+    plain = [make_row(keys) for i in range(rows)]
+    loaded = [DatabaseDict(row) for row in plain]
+
+    report('plain dict (coerced)', rows, best_of(lambda: [HStoreDict(row) for row in plain]))
+    report('database dict (trusted)', rows, best_of(lambda: [HStoreDict(row) for row in loaded]))
+
+
+@benchmark
+def json_backends(rows=2000, keys=200):
+    """
+    json backends on the payloads encoded and decoded by HStoreDict, form fields and widgets
+    """
+    from django_hstore.utils import get_json_backend
+
+    row = make_row(keys)
+    text = get_json_backend().dumps(row)
+    nested = {'list': ['a', 'b', 1, False], 'dict': {'subkey': 'subvalue', 'number': 1.5}}
+
+    for path in ('json', 'simplejson', 'ujson'):
+        try:
+            json = get_json_backend(path)
+        except ImportError:
+            print('    %s is not installed' % path)
+            continue
+        report('%s: dumps (HStoreDict string)' % path, rows, best_of(lambda: [json.dumps(row) for i in range(rows)]))
+        report('%s: loads (HStoreDict, forms)' % path, rows, best_of(lambda: [json.loads(text) for i in range(rows)]))
+        report('%s: dumps (nested values)' % path, rows, best_of(lambda: [json.dumps(nested) for i in range(rows)]))
+        report('%s: dumps (widget)' % path, rows,
+               best_of(lambda: [json.dumps(row, sort_keys=True, indent=4) for i in range(rows)]))
+
+
+@benchmark
+def model_instantiation(rows=20000):
+    """
+    instantiation of unsaved models with hstore default values
+    """
+    from django_hstore_tests.models import DataBag, DefaultsModel
+
+    report('DataBag()', rows, best_of(lambda: [DataBag() for i in range(rows)]))
+    report('DefaultsModel()', rows, best_of(lambda: [DefaultsModel() for i in range(rows)]))
+
+
+@benchmark
+def queryset_iteration(rows=2000, keys=200):
+    """
+    iteration of a queryset of rows with a large hstore column
+    """
+    from django_hstore_tests.models import DataBag
+
+    from django_hstore import apps
+
+    DataBag.objects.bulk_create([DataBag(name='bench', data=make_row(keys)) for i in range(rows)])
+    report('DataBag.objects.all()', rows, best_of(lambda: list(DataBag.objects.all())))
+    apps.HSTORE_DEFERRED_PARSING = True
+    report('DataBag.objects.all() (deferred parsing)', rows, best_of(lambda: list(DataBag.objects.all())))
+    apps.HSTORE_DEFERRED_PARSING = False
+    DataBag.objects.all().delete()
+
+
+@benchmark
+def hstore_parser(rows=2000, keys=200):
+    """
+    parsing of the text representation of hstore values
+    """
+    from psycopg2.extras import HstoreAdapter
+    from django_hstore.parser import parse_hstore
+
+    text = ', '.join('"%s"=>"%s"' % item for item in make_row(keys).items())
+    report('psycopg2 HstoreAdapter.parse', rows, best_of(lambda: [HstoreAdapter.parse(text, None) for i in range(rows)]))
+    report('django_hstore.parser.parse_hstore', rows, best_of(lambda: [parse_hstore(text) for i in range(rows)]))
+
+
+@benchmark
+def queryset_memory(rows=2000, keys=200):
+    """
+    memory used by a queryset of rows with a large hstore column
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        print('    tracemalloc is not available')
+        return
+    from django_hstore import apps
+    from django_hstore_tests.models import DataBag
+
+    def bytes_per_row():
+        tracemalloc.start()
+        try:
+            bags = list(DataBag.objects.all())
+            return tracemalloc.get_traced_memory()[0] / len(bags)
+        finally:
+            tracemalloc.stop()
+
+    DataBag.objects.bulk_create([DataBag(name='bench', data=make_row(keys)) for i in range(rows)])
+    print('    %-40s %12.0f bytes/row' % ('plain keys', bytes_per_row()))
+    apps.HSTORE_SHARE_KEYS = True
+    print('    %-40s %12.0f bytes/row' % ('shared keys', bytes_per_row()))
+    apps.HSTORE_SHARE_KEYS = False
+    DataBag.objects.all().delete()
+
+
+@benchmark
+def queryset_stream(rows=5000, keys=200):
+    """
+    iteration of a large queryset with a client side cursor vs stream()
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    from django_hstore_tests.models import DataBag
+
+    def consume(iterable):
+        for bag in iterable:
+            pass
+
+    def peak_bytes(iterable):
+        tracemalloc.start()
+        try:
+            consume(iterable)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    DataBag.objects.bulk_create([DataBag(name='bench', data=make_row(keys)) for i in range(rows)])
+    report('DataBag.objects.iterator()', rows, best_of(lambda: consume(DataBag.objects.iterator()), repeat=3))
+    report('DataBag.objects.all().stream()', rows, best_of(lambda: consume(DataBag.objects.all().stream()), repeat=3))
+    if tracemalloc:
+        print('    %-40s %12.0f bytes peak' % ('iterator()', peak_bytes(DataBag.objects.iterator())))
+        print('    %-40s %12.0f bytes peak' % ('stream()', peak_bytes(DataBag.objects.all().stream())))
+    else:
+        print('    tracemalloc is not available')
+    DataBag.objects.all().delete()
+
+
+@benchmark
+def contains_any(rows=200000):
+    """
+    data__contains={'color': [...]} on a table with a gin index, before and after rewriting it with @>
+    """
+    from django.db import connection
+    from django_hstore.explain import explain
+    from django_hstore_tests.models import DataBag
+
+    colors = ['red', 'green', 'blue', 'black', 'white', 'yellow', 'orange', 'purple'] + \
+             ['color%d' % i for i in range(992)]
+    cursor = connection.cursor()
+    cursor.execute(
+        "INSERT INTO django_hstore_tests_databag (name, data) "
+        "SELECT 'bench', hstore(ARRAY['color', 'size', 'n'], ARRAY[(%s)[1 + i %% %s], 'L', i::text]) "
+        "FROM generate_series(1, %s) AS i", [colors, len(colors), rows]
+    )
+    cursor.execute('CREATE INDEX benchmark_databag_data_gin ON django_hstore_tests_databag USING gin (data)')
+    cursor.execute('ANALYZE django_hstore_tests_databag')
+
+    # the condition generated before the rewrite
+    table = connection.ops.quote_name(DataBag._meta.db_table)
+    old_sql = 'SELECT * FROM %s WHERE %s."data"->\'color\' = ANY(%%s)' % (table, table)
+    queryset = DataBag.objects.filter(data__contains={'color': ['red', 'blue']})
+    new_sql, new_params = queryset.query.get_compiler(connection.alias).as_sql()
+
+    for label, sql, params in (('->\'color\' = ANY(...)', old_sql, [['red', 'blue']]),
+                               ('@> ANY(...)', new_sql, new_params)):
+        explanation = explain(connection, sql, params, analyze=True)
+        plan = explanation.plan[0]
+        # Total Runtime before postgresql 9.4
+        milliseconds = plan.get('Execution Time', plan.get('Total Runtime'))
+        print('    %-40s %s, %.1f ms' % (label, plan['Plan']['Node Type'], milliseconds))
+        for line in str(explanation).splitlines():
+            print('        %s' % line)
+
+    cursor.execute('DROP INDEX benchmark_databag_data_gin')
+    DataBag.objects.all().delete()
+
+
+def main(argv):
+    settings = 'settings'
+    names = []
+    for arg in argv:
+        if arg.startswith('--settings='):
+            settings = arg.split('=', 1)[1]
+        else:
+            names.append(arg)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings)
+
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.db import connection
+
+    old_database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        for func in BENCHMARKS:
+            if names and func.__name__ not in names:
+                continue
+            print('%s: %s' % (func.__name__, func.__doc__.strip()))
+            func()
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
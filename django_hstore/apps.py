@@ -1,9 +1,15 @@
 import sys
+import weakref
 
 import django
 from django.conf import settings
 from django.db.backends.signals import connection_created
-from psycopg2.extras import register_hstore
+from django.utils import six
+from psycopg2.extensions import new_type, register_type, encodings
+from psycopg2.extras import register_hstore, HstoreAdapter
+
+from .dict import DatabaseDict, RawHStore
+from .prepared import use_prepared_statements
 
 try:
     from django.apps import AppConfig
@@ -31,6 +37,33 @@ Use DJANGO_HSTORE_ADAPTER_REGISTRATION by setting it either to 'global' or 'conn
     DeprecationWarning)
 
 
+# Share key strings among the dictionaries fetched by the same query
+# in order to reduce memory usage of large result sets, at the cost of
+# an additional dictionary lookup for each key.
+HSTORE_SHARE_KEYS = getattr(settings, "DJANGO_HSTORE_SHARE_KEYS", False)
+
+# Keep the text of fetched hstore values and parse it only when the
+# dictionary of a model instance is accessed for the first time.
+HSTORE_DEFERRED_PARSING = getattr(settings, "DJANGO_HSTORE_DEFERRED_PARSING", False)
+
+# Prepare the statements with hstore conditions on each connection, so that
+# repeated queries are parsed and planned only once; not suitable for
+# connection poolers which share server sessions among clients.
+HSTORE_PREPARED_STATEMENTS = getattr(settings, "DJANGO_HSTORE_PREPARED_STATEMENTS", False)
+
+# key tables, one for each cursor, discarded together with the cursor
+cursor_key_tables = weakref.WeakKeyDictionary()
+
+
+def share_keys(value, cursor):
+    """
+    returns a DatabaseDict whose keys are shared with the
+    other dictionaries fetched by the same cursor
+    """
+    keys = cursor_key_tables.setdefault(cursor, {})
+    return DatabaseDict((keys.setdefault(key, key), val) for key, val in value.items())
+
+
 class ConnectionCreateHandler(object):
     """
     Generic connection handlers manager.
@@ -77,16 +110,51 @@ def register_hstore_handler(connection, **kwargs):
                                           vendor="postgresql", unique=HSTORE_REGISTER_GLOBALLY)
         return
 
+    oid, array_oid = HstoreAdapter.get_oids(connection.connection)
+    # let psycopg2 raise its usual error if hstore is not installed
+    if not oid:
+        oid = array_oid = None
+
     if sys.version_info[0] < 3:
-        register_hstore(connection.connection, globally=HSTORE_REGISTER_GLOBALLY, unicode=True)
+        register_hstore(connection.connection, globally=HSTORE_REGISTER_GLOBALLY, unicode=True,
+                        oid=oid, array_oid=array_oid)
+        parse = HstoreAdapter.parse_unicode
     else:
-        register_hstore(connection.connection, globally=HSTORE_REGISTER_GLOBALLY)
+        register_hstore(connection.connection, globally=HSTORE_REGISTER_GLOBALLY,
+                        oid=oid, array_oid=array_oid)
+        parse = HstoreAdapter.parse
+
+    # override the typecaster installed by psycopg2 in order to mark
+    # dictionaries coming from the database, which don't need coercion
+    def cast(value, cursor):
+        if HSTORE_DEFERRED_PARSING and value is not None:
+            if not isinstance(value, six.text_type):
+                value = value.decode(encodings[cursor.connection.encoding])
+            return RawHStore(value)
+        value = parse(value, cursor)
+        if value is None:
+            return None
+        if HSTORE_SHARE_KEYS and cursor is not None:
+            return share_keys(value, cursor)
+        return DatabaseDict(value)
+
+    HSTORE = new_type(oid, 'HSTORE', cast)
+    register_type(HSTORE, None if HSTORE_REGISTER_GLOBALLY else connection.connection)
 
 
 connection_handler.attach_handler(register_hstore_handler,
                                   vendor="postgresql", unique=HSTORE_REGISTER_GLOBALLY)
 
 
+def register_prepared_statements_handler(connection, **kwargs):
+    if connection.vendor == 'postgresql':
+        use_prepared_statements(connection)
+
+
+if HSTORE_PREPARED_STATEMENTS:
+    connection_handler.attach_handler(register_prepared_statements_handler, vendor="postgresql")
+
+
 class HStoreConfig(AppConfig):
     name = 'django_hstore'
     verbose = 'Django HStore'
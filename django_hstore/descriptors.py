@@ -1,5 +1,6 @@
 from django.db import models
 from .dict import *
+from .dict import RawHStore
 
 
 __all__ = [
@@ -15,9 +16,26 @@ class HStoreDescriptor(models.fields.subclassing.Creator):
         self.schema_mode = kwargs.pop('schema_mode', False)
         super(HStoreDescriptor, self).__init__(*args, **kwargs)
     
+    def __get__(self, obj, type=None):
+        value = super(HStoreDescriptor, self).__get__(obj, type)
+        # parse the hstore fetched with deferred parsing on first access
+        if isinstance(value, RawHStore):
+            value = self._DictClass(
+                value=value.parse(), field=self.field, instance=obj, schema_mode=self.schema_mode
+            )
+            obj.__dict__[self.field.name] = value
+        return value
+
     def __set__(self, obj, value):
+        # keep an hstore fetched with deferred parsing as it is until accessed
+        if isinstance(value, RawHStore):
+            obj.__dict__[self.field.name] = value
+            return
         value = self.field.to_python(value)
-        if isinstance(value, dict):
+        # no need to copy a dictionary assigned again to its own instance
+        if isinstance(value, dict) and not (
+            type(value) is self._DictClass and value.instance is obj and value.field is self.field
+        ):
             value = self._DictClass(
                 value=value, field=self.field, instance=obj, schema_mode=self.schema_mode
             )
@@ -1,8 +1,3 @@
-try:
-    import simplejson as json
-except ImportError:
-    import json
-
 from decimal import Decimal
 
 from django.utils import six
@@ -10,27 +5,70 @@ from django.utils.encoding import force_text, force_str
 
 from .compat import UnicodeMixin
 from . import utils, exceptions
+from .utils import json
+from .parser import parse_hstore
 
 
 __all__ = [
     'HStoreDict',
+    'FrozenHStoreDict',
     'HStoreReferenceDict',
 ]
 
 
+class DatabaseDict(dict):
+    """
+    A plain dictionary as returned by the hstore typecaster.
+    Its keys and values are strings already, so HStoreDict
+    can wrap it without coercing each value.
+    """
+    pass
+
+
+class RawHStore(six.text_type):
+    """
+    The text representation of an hstore as returned by the database
+    when parsing is deferred, it is parsed when the dictionary is accessed.
+    """
+    __slots__ = ()
+
+    def parse(self):
+        return DatabaseDict(parse_hstore(self))
+
+
 class HStoreDict(UnicodeMixin, dict):
     """
     A dictionary subclass which implements hstore support.
     """
 
-    schema_mode = False  # python2.6 compatibility
+    # no per instance __dict__, large result sets contain lots of dictionaries
+    # changed_keys: keys set or deleted since the dictionary was loaded from the database,
+    # None if the dictionary has not been loaded from the database
+    # _typed_values: values converted by the virtual fields in schema mode
+    __slots__ = ('field', 'instance', 'schema_mode', 'changed_keys', '_typed_values')
+
+    def __new__(cls, *args, **kwargs):
+        # slots are set before unpickling the items, which pickles
+        # made before the slots were added restore through __setitem__
+        self = super(HStoreDict, cls).__new__(cls, *args, **kwargs)
+        self.field = None
+        self.instance = None
+        self.schema_mode = False
+        self.changed_keys = None
+        self._typed_values = None
+        return self
 
     def __init__(self, value=None, field=None, instance=None, schema_mode=False, **kwargs):
         self.schema_mode = schema_mode
+        self.changed_keys = None
+        self._typed_values = None
 
+        # if passed value is an hstore fetched with deferred parsing
+        if isinstance(value, RawHStore):
+            value = value.parse()
         # if passed value is string
         # ensure is json formatted
-        if isinstance(value, six.string_types):
+        elif isinstance(value, six.string_types):
             try:
                 value = json.loads(value)
             except ValueError as e:
@@ -47,7 +85,10 @@ class HStoreDict(UnicodeMixin, dict):
                 'HStoreDict accepts only dictionary objects, None and json formatted string representations of json objects'
             )
 
-        if not self.schema_mode:
+        # values loaded from the database are strings already, values
+        # of another HStoreDict in the same mode have been checked already
+        if not self.schema_mode and not isinstance(value, DatabaseDict) and \
+           not (isinstance(value, HStoreDict) and not value.schema_mode):
             # ensure values are acceptable
             for key, val in value.items():
                 value[key] = self.ensure_acceptable_value(val)
@@ -55,6 +96,9 @@ class HStoreDict(UnicodeMixin, dict):
         super(HStoreDict, self).__init__(value, **kwargs)
         self.field = field
         self.instance = instance
+        # track changes only if loaded from the database
+        if isinstance(value, DatabaseDict):
+            self.changed_keys = set()
 
     def __setitem__(self, *args, **kwargs):
         """
@@ -65,18 +109,33 @@ class HStoreDict(UnicodeMixin, dict):
         # prepare *args
         args = (args[0], value)
         super(HStoreDict, self).__setitem__(*args, **kwargs)
+        self._track_change(args[0])
+
+    def __delitem__(self, key):
+        super(HStoreDict, self).__delitem__(key)
+        self._track_change(key)
 
     def __getitem__(self, *args, **kwargs):
         """
         retrieve value preserving type if in schema mode, string only otherwise
         """
+        if self.schema_mode and self._typed_values:
+            try:
+                return self._typed_values[args[0]]
+            except KeyError:
+                pass
+
         value = super(HStoreDict, self).__getitem__(*args, **kwargs)
 
         if self.schema_mode:
             try:
-                return self.instance._hstore_virtual_fields[args[0]].to_python(value)
+                value = self.instance._hstore_virtual_fields[args[0]].to_python(value)
             except KeyError:
-                pass
+                return value
+            # convert each value only once
+            if self._typed_values is None:
+                self._typed_values = {}
+            self._typed_values[args[0]] = value
 
         return value
 
@@ -96,15 +155,53 @@ class HStoreDict(UnicodeMixin, dict):
         return force_text(json.dumps(self))
 
     def __getstate__(self):
-        return self.__dict__
+        return dict((name, getattr(self, name)) for name in ('field', 'instance', 'schema_mode', 'changed_keys'))
+
+    def __setstate__(self, state):
+        # protocols 0 and 1 restore pickles made before the slots
+        # were added without calling __new__, some slots may be missing
+        for name, default in (('field', None), ('instance', None), ('schema_mode', False),
+                              ('changed_keys', None), ('_typed_values', None)):
+            setattr(self, name, state.get(name, default))
+
+    def __reduce__(self):
+        # items are restored before the state, init an empty dictionary first
+        return (self.__class__, (), self.__getstate__(), None, iter(list(dict.items(self))))
 
     def __copy__(self):
-        return self.__class__(self, self.field)
+        # items are copied as they are, without being checked again
+        return self.__class__(self, self.field, self.instance, self.schema_mode)
 
     def update(self, *args, **kwargs):
-        for key, value in dict(*args, **kwargs).iteritems():
+        for key, value in six.iteritems(dict(*args, **kwargs)):
             self[key] = value
 
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self._track_change(key)
+        return super(HStoreDict, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(HStoreDict, self).popitem()
+        self._track_change(key)
+        return key, value
+
+    def clear(self):
+        for key in self.keys():
+            self._track_change(key)
+        super(HStoreDict, self).clear()
+
+    def _track_change(self, key):
+        if self._typed_values:
+            self._typed_values.pop(key, None)
+        if self.changed_keys is not None:
+            self.changed_keys.add(key)
+
     def ensure_acceptable_value(self, value):
         """
         if schema_mode disabled (default behaviour):
@@ -141,22 +238,64 @@ class HStoreDict(UnicodeMixin, dict):
         queryset.filter(pk=self.instance.pk).hremove(self.field.name, keys)
 
 
+class FrozenHStoreDict(HStoreDict):
+    """
+    An immutable HStoreDict, used as template of default values shared
+    by all the instances of a model, which get their own copy of it
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
 class HStoreReferenceDict(HStoreDict):
     """
     A dictionary which adds support to storing references to models
     """
+    __slots__ = ()
+
     def __getitem__(self, *args, **kwargs):
         value = super(self.__class__, self).__getitem__(*args, **kwargs)
-        # if value is a string it needs to be converted to model instance
+        # if value is a string all references need to be converted to model instances
         if isinstance(value, six.string_types):
-            reference = utils.acquire_reference(value)
-            self.__setitem__(args[0], reference)
-            return reference
+            self.resolve()
+            return dict.__getitem__(self, args[0])
         # otherwise just return the relation
         return value
 
+    def resolve(self):
+        """
+        converts all the references to model instances,
+        performing one query for each referenced model
+        """
+        resolve_references([self])
+        return self
+
     def get(self, key, default=None):
         try:
             return self.__getitem__(key)
         except KeyError:
             return default
+
+
+def resolve_references(dictionaries):
+    """
+    converts the references of all the specified dictionaries to model
+    instances, performing one query for each referenced model
+    """
+    references = {}
+    for index, dictionary in enumerate(dictionaries):
+        for key, value in dict.items(dictionary):
+            if isinstance(value, six.string_types):
+                references[(index, key)] = value
+
+    if references:
+        for (index, key), instance in utils.acquire_references(references).items():
+            # caching the instance is not a change of the dictionary
+            dict.__setitem__(dictionaries[index], key, instance)
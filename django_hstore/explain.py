@@ -0,0 +1,74 @@
+from __future__ import unicode_literals, absolute_import
+
+import re
+
+from django.utils import six
+
+from .compat import UnicodeMixin
+from .utils import json
+
+
+__all__ = [
+    'HStoreExplanation',
+    'explain'
+]
+
+
+# operators of hstore conditions, longest first
+_re_operator = re.compile(r'@>|<@|\?\||\?&|\?|->')
+
+
+class HStoreExplanation(UnicodeMixin):
+    """
+    The plan of a query, with the sequential scans filtered by hstore
+    operators, which could not use any index, and the indexes used;
+    queries which match no rows without being executed have no plan
+    """
+
+    def __init__(self, sql, plan):
+        self.sql = sql
+        self.plan = plan
+        self.seq_scans = []
+        self.indexes = []
+        if plan:
+            self._inspect(plan[0]['Plan'])
+
+    def _inspect(self, node):
+        if node.get('Index Name'):
+            self.indexes.append(node['Index Name'])
+        if node['Node Type'] == 'Seq Scan' and node.get('Filter'):
+            operators = sorted(set(_re_operator.findall(node['Filter'])))
+            if operators:
+                self.seq_scans.append({
+                    'relation': node['Relation Name'],
+                    'filter': node['Filter'],
+                    'operators': operators
+                })
+        for child in node.get('Plans', []):
+            self._inspect(child)
+
+    def __unicode__(self):
+        lines = []
+        for scan in self.seq_scans:
+            lines.append('sequential scan on %s caused by %s: %s' % (
+                scan['relation'], ', '.join(scan['operators']), scan['filter']
+            ))
+        if self.indexes:
+            lines.append('indexes used: %s' % ', '.join(self.indexes))
+        return '\n'.join(lines) or 'no hstore conditions'
+
+
+def explain(connection, sql, params=None, analyze=False):
+    """
+    explains the specified query, which is also executed if analyze is True
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (%sFORMAT JSON) %s' % ('ANALYZE, ' if analyze else '', sql), params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    # psycopg2 < 2.5 does not decode json
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return HStoreExplanation(sql, plan)
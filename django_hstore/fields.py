@@ -1,18 +1,23 @@
 from __future__ import unicode_literals, absolute_import
 
 from django.db import models, connection
+from django.db.models import signals
+from django.db.models.query_utils import QueryWrapper
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ImproperlyConfigured
 from django import get_version
 
 from .descriptors import *
 from .dict import *
+from .dict import RawHStore
 from .virtual import *
+from .indexes import validate_indexes
 from . import forms, utils
 
 
 class HStoreField(models.Field):
     """ HStore Base Field """
+    _default_template = None
 
     def __init_dict(self, value):
         """
@@ -20,6 +25,15 @@ class HStoreField(models.Field):
         """
         return HStoreDict(value, self)
 
+    def __get_default_template(self, default):
+        """
+        returns an immutable HStoreDict prepared only once, the descriptor
+        gives each model instance its own copy without checking it again
+        """
+        if self._default_template is None or self._default_template[0] is not default:
+            self._default_template = (default, FrozenHStoreDict(dict(default or {})))
+        return self._default_template[1]
+
     def validate(self, value, *args):
         super(HStoreField, self).validate(value, *args)
         forms.validate_hstore(value)
@@ -27,6 +41,53 @@ class HStoreField(models.Field):
     def contribute_to_class(self, cls, name):
         super(HStoreField, self).contribute_to_class(cls, name)
         setattr(cls, self.name, HStoreDescriptor(self))
+        if not cls._meta.abstract:
+            # proxy and multi-table inheritance children send the signal
+            # with their own class as sender, reset_changed_keys filters them
+            signals.post_save.connect(self.reset_changed_keys)
+
+    def pre_save(self, model_instance, add):
+        # an hstore fetched with deferred parsing which has never been accessed is unchanged
+        if not add and isinstance(model_instance.__dict__.get(self.attname), RawHStore):
+            return QueryWrapper('"%s"' % self.column, [])
+        value = super(HStoreField, self).pre_save(model_instance, add)
+        # when updating send only the keys which have been changed since load
+        if not add and isinstance(value, HStoreDict) and value.changed_keys is not None:
+            return self.get_changes_expression(value)
+        return value
+
+    def get_changes_expression(self, value):
+        """
+        returns an expression which applies the changes of the
+        specified HStoreDict to the value stored in the database
+        """
+        updates = {}
+        deletes = []
+        for key in value.changed_keys:
+            if key in value:
+                updates[key] = dict.__getitem__(value, key)
+            else:
+                deletes.append(key)
+
+        sql, params = '"%s"' % self.column, []
+        if deletes:
+            sql, params = 'delete(%s, %%s)' % sql, [deletes]
+        if updates:
+            sql, params = '%s || %%s' % sql, params + [self.get_prep_value(updates)]
+        return QueryWrapper(sql, params)
+
+    def reset_changed_keys(self, instance, update_fields=None, **kwargs):
+        """
+        the database is up to date after a save, start tracking changes from now on
+        """
+        if not isinstance(instance, self.model):
+            return
+        if update_fields is not None and self.name not in update_fields:
+            return
+        # avoid loading deferred fields
+        value = instance.__dict__.get(self.name)
+        if isinstance(value, HStoreDict):
+            value.changed_keys = set()
 
     def get_default(self):
         """
@@ -39,11 +100,11 @@ class HStoreField(models.Field):
                 return self.__init_dict(self.default())
             # if it's a dict
             elif isinstance(self.default, dict):
-                return self.__init_dict(self.default)
+                return self.__get_default_template(self.default)
             # else just return it
             return self.default
         # default to empty dict
-        return self.__init_dict({})
+        return self.__get_default_template(None)
 
     def get_prep_value(self, value):
         if isinstance(value, dict) and not isinstance(value, HStoreDict):
@@ -56,6 +117,15 @@ class HStoreField(models.Field):
             value = self.get_prep_value(value)
         return value
 
+    def get_transform(self, name):
+        """
+        any name which is not a lookup is the key of a KeyTransform (django >= 1.7)
+        """
+        transform = super(HStoreField, self).get_transform(name)
+        if transform is not None:
+            return transform
+        return KeyTransformFactory(name, getattr(self, 'casts', {}).get(name))
+
     def value_to_string(self, obj):
         return self._get_val_from_obj(obj)
 
@@ -78,6 +148,15 @@ if get_version() >= '1.7':
     HStoreField.register_lookup(HStoreLessThanOrEqual)
     HStoreField.register_lookup(HStoreContains)
     HStoreField.register_lookup(HStoreIContains)
+    HStoreField.register_lookup(HStoreHasKey)
+    HStoreField.register_lookup(HStoreHasKeys)
+    HStoreField.register_lookup(HStoreHasAnyKeys)
+    HStoreField.register_lookup(HStoreContainedBy)
+
+    KeyTransform.register_lookup(KeyGreaterThan)
+    KeyTransform.register_lookup(KeyGreaterThanOrEqual)
+    KeyTransform.register_lookup(KeyLessThan)
+    KeyTransform.register_lookup(KeyLessThanOrEqual)
 
 
 class DictionaryField(HStoreField):
@@ -86,6 +165,23 @@ class DictionaryField(HStoreField):
     def __init__(self, *args, **kwargs):
         self.schema = kwargs.pop('schema', None)
         self.schema_mode = False
+        # types to which the values of keys are cast in gt, gte, lt and lte lookups
+        self.declared_casts = kwargs.pop('casts', None) or {}
+        for cast in self.declared_casts.values():
+            utils.check_cast(cast)
+        # together with the casts of the indexes
+        self.casts = dict(self.declared_casts)
+        # indexes created by the migration operations in django_hstore.indexes
+        self.indexes = kwargs.pop('indexes', None) or []
+        validate_indexes(self.indexes)
+        # lookups on the indexed keys use the cast and the condition of their index
+        self.partial_index_keys = set()
+        for index in self.indexes:
+            if isinstance(index, dict):
+                if index.get('cast'):
+                    self.casts.setdefault(index['key'], index['cast'])
+                if index.get('partial'):
+                    self.partial_index_keys.add(index['key'])
 
         # if schema parameter is supplied the behaviour is slightly different
         if self.schema is not None:
@@ -117,6 +213,14 @@ class DictionaryField(HStoreField):
         if self.schema:
             self._create_hstore_virtual_fields(cls, name)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(DictionaryField, self).deconstruct()
+        if self.declared_casts:
+            kwargs['casts'] = self.declared_casts
+        if self.indexes:
+            kwargs['indexes'] = self.indexes
+        return name, path, args, kwargs
+
     def _validate_schema(self, schema):
         if not isinstance(schema, list):
             raise ValueError('schema parameter must be a list')
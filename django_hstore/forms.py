@@ -1,10 +1,5 @@
 from __future__ import unicode_literals, absolute_import
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
-
 from django.forms import Field
 from django.utils import six
 from django.utils.translation import ugettext
@@ -12,6 +7,7 @@ from django.core.exceptions import ValidationError
 
 from .widgets import AdminHStoreWidget
 from . import utils
+from .utils import json
 
 
 def validate_hstore(value):
@@ -0,0 +1,187 @@
+from __future__ import unicode_literals, absolute_import
+
+import hashlib
+
+from django import get_version
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils import six
+from django.utils.encoding import force_bytes
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from .utils import check_cast, key_expression, quote_key
+
+
+__all__ = [
+    'validate_indexes',
+    'get_index_statements',
+    'create_indexes',
+    'drop_indexes'
+]
+
+
+# whole column indexes, used by the @>, ?, ?& and ?| operators
+COLUMN_INDEX_TYPES = ('gin', 'gist')
+
+
+def validate_indexes(indexes):
+    """
+    ensures indexes is a list of index definitions, either:
+        * "gin" or "gist": an index on the whole column
+        * {"key": "price", "cast": "numeric", "partial": True}: a btree index
+          on the value of the key, optionally cast and limited to the rows
+          containing the key
+    """
+    if not isinstance(indexes, (list, tuple)):
+        raise ValueError('indexes parameter must be a list')
+
+    for index in indexes:
+        if isinstance(index, six.string_types):
+            if index not in COLUMN_INDEX_TYPES:
+                raise ValueError('index type %s is not one of %s' % (index, ', '.join(COLUMN_INDEX_TYPES)))
+        elif isinstance(index, dict):
+            if not isinstance(index.get('key'), six.string_types):
+                raise ValueError('index %s is missing the key' % index)
+            if index.get('cast') is not None:
+                check_cast(index['cast'])
+            unknown = set(index) - set(['key', 'cast', 'partial'])
+            if unknown:
+                raise ValueError('index %s has unknown options: %s' % (index, ', '.join(sorted(unknown))))
+        else:
+            raise ValueError('indexes parameter must contain index types or dicts representing key indexes')
+
+
+def index_name(table, column, suffix):
+    # identifiers are truncated to 63 characters by postgresql
+    name = '%s_%s_%s' % (table, column, suffix)
+    if len(name) > 63:
+        name = '%s_%s' % (name[:54], hashlib.md5(force_bytes(name)).hexdigest()[:8])
+    return name
+
+
+def get_index_statements(model, field, concurrently=False, using=DEFAULT_DB_ALIAS):
+    """
+    returns a list of (name, create sql, drop sql) tuples of the indexes
+    declared in the indexes option of the specified field, for the database using
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    column = qn(field.column)
+    concurrently = ' CONCURRENTLY' if concurrently else ''
+    statements = []
+
+    for index in field.indexes:
+        if isinstance(index, six.string_types):
+            name = index_name(table, field.column, index)
+            sql = 'CREATE INDEX%s %s ON %s USING %s (%s)' % (concurrently, qn(name), qn(table), index, column)
+        else:
+            cast = index.get('cast')
+            # different casts of the same key get different names
+            digest = hashlib.md5(force_bytes('%s::%s' % (index['key'], cast))).hexdigest()[:8]
+            name = index_name(table, field.column, 'key_%s' % digest)
+            expression = key_expression(column, cast, quote_key(index['key']))
+            sql = 'CREATE INDEX%s %s ON %s (%s)' % (concurrently, qn(name), qn(table), expression)
+            if index.get('partial'):
+                sql = '%s WHERE %s ? %s' % (sql, column, quote_key(index['key']))
+        statements.append((name, sql, 'DROP INDEX%s IF EXISTS %s' % (concurrently, qn(name))))
+
+    return statements
+
+
+def execute_concurrently(connection, statements):
+    """
+    executes the statements in a new connection in autocommit mode,
+    CREATE INDEX CONCURRENTLY cannot run in a transaction
+    """
+    other = connection.__class__(connection.settings_dict.copy(), alias=connection.alias)
+    try:
+        cursor = other.cursor()
+        # through psycopg2, DatabaseWrapper.set_autocommit requires django >= 1.6;
+        # the transaction opened by django < 1.6 along with the connection is rolled back
+        other.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        for sql in statements:
+            cursor.execute(sql)
+    finally:
+        other.close()
+
+
+def create_indexes(model, field_name, concurrently=False, using=DEFAULT_DB_ALIAS):
+    """
+    creates the indexes declared in the indexes option of the specified field,
+    without locking writes to the table if concurrently is True
+    """
+    field = model._meta.get_field(field_name)
+    statements = [create for name, create, drop in get_index_statements(model, field, concurrently, using)]
+    _execute(connections[using], statements, concurrently)
+
+
+def drop_indexes(model, field_name, concurrently=False, using=DEFAULT_DB_ALIAS):
+    """
+    drops the indexes declared in the indexes option of the specified field
+    """
+    field = model._meta.get_field(field_name)
+    statements = [drop for name, create, drop in get_index_statements(model, field, concurrently, using)]
+    _execute(connections[using], statements, concurrently)
+
+
+def _execute(connection, statements, concurrently):
+    if concurrently:
+        execute_concurrently(connection, statements)
+    else:
+        cursor = connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+
+
+if get_version() >= '1.7':
+    from django.db.migrations.operations.base import Operation
+
+    __all__ += ['CreateHStoreIndexes']
+
+    class CreateHStoreIndexes(Operation):
+        """
+        Migration operation which creates the indexes declared in the
+        indexes option of a DictionaryField, and drops them when reversed.
+        Indexes created concurrently are created in a new connection, outside
+        the transaction of the migration, which should contain only this operation.
+        """
+        reduces_to_sql = True
+        reversible = True
+
+        def __init__(self, model_name, field_name, concurrently=False):
+            self.model_name = model_name
+            self.field_name = field_name
+            self.concurrently = concurrently
+
+        def deconstruct(self):
+            kwargs = {'model_name': self.model_name, 'field_name': self.field_name}
+            if self.concurrently:
+                kwargs['concurrently'] = self.concurrently
+            return self.__class__.__name__, [], kwargs
+
+        def state_forwards(self, app_label, state):
+            pass
+
+        def database_forwards(self, app_label, schema_editor, from_state, to_state):
+            self._run(app_label, schema_editor, to_state, 1)
+
+        def database_backwards(self, app_label, schema_editor, from_state, to_state):
+            self._run(app_label, schema_editor, from_state, 2)
+
+        def _run(self, app_label, schema_editor, state, statement):
+            model = state.render().get_model(app_label, self.model_name)
+            if not self.allowed_to_migrate(schema_editor.connection.alias, model):
+                return
+            field = model._meta.get_field(self.field_name)
+            statements = [s[statement] for s in get_index_statements(
+                model, field, self.concurrently, schema_editor.connection.alias)]
+            if self.concurrently and not schema_editor.collect_sql:
+                execute_concurrently(schema_editor.connection, statements)
+            else:
+                for sql in statements:
+                    schema_editor.execute(sql)
+
+        def describe(self):
+            return 'Create%s hstore indexes on %s.%s' % (
+                ' concurrently' if self.concurrently else '', self.model_name, self.field_name
+            )
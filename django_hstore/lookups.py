@@ -1,15 +1,20 @@
 from __future__ import unicode_literals, absolute_import
 
 from django.utils import six
+from django.db.models import TextField
 from django.db.models.lookups import (
     GreaterThan,
     GreaterThanOrEqual,
     LessThan,
     LessThanOrEqual,
     Contains,
-    IContains
+    IContains,
+    Lookup,
+    Transform
 )
 
+from .utils import get_comparison_sql, get_contains_sql, key_expression
+
 
 __all__ = [
     'HStoreComparisonLookupMixin',
@@ -18,7 +23,17 @@ __all__ = [
     'HStoreLessThan',
     'HStoreLessThanOrEqual',
     'HStoreContains',
-    'HStoreIContains'
+    'HStoreIContains',
+    'HStoreHasKey',
+    'HStoreHasKeys',
+    'HStoreHasAnyKeys',
+    'HStoreContainedBy',
+    'KeyTransform',
+    'KeyTransformFactory',
+    'KeyGreaterThan',
+    'KeyGreaterThanOrEqual',
+    'KeyLessThan',
+    'KeyLessThanOrEqual'
 ]
 
 
@@ -31,15 +46,7 @@ class HStoreComparisonLookupMixin(object):
         lhs, lhs_params = self.process_lhs(qn, connection)
         rhs, rhs_params = self.process_rhs(qn, connection)
         if len(rhs_params) == 1 and isinstance(rhs_params[0], dict):
-            param = rhs_params[0]
-            sign = (self.lookup_name[0] == 'g' and '>%s' or '<%s') % (self.lookup_name[-1] == 'e' and '=' or '')
-            param_keys = list(param.keys())
-            conditions = []
-
-            for key in param_keys:
-                conditions.append('(%s->\'%s\') %s %%s' % (lhs, key, sign))
-
-            return (" AND ".join(conditions), param.values())
+            return get_comparison_sql(lhs, self.lhs.output_field, rhs_params[0], self.lookup_name)
 
         raise ValueError('invalid value')
 
@@ -73,13 +80,7 @@ class HStoreContains(Contains):
         param = self.rhs
 
         if isinstance(param, dict):
-            values = list(param.values())
-            keys = list(param.keys())
-
-            if len(values) == 1 and isinstance(values[0], (list, tuple)):
-                return '%s->\'%s\' = ANY(%%s)' % (lhs, keys[0]), [[str(x) for x in values[0]]]
-
-            return '%s @> %%s' % lhs, [param]
+            return get_contains_sql(lhs, self.lhs.output_field, param)
 
         elif isinstance(param, (list, tuple)):
             if len(param) == 0:
@@ -102,3 +103,122 @@ class HStoreContains(Contains):
 
 class HStoreIContains(IContains, HStoreContains):
     pass
+
+
+class HStoreOperatorLookup(Lookup):
+    """
+    Base class of the lookups which compare the column
+    with the value through an hstore operator.
+    """
+    operator = None
+
+    def get_prep_lookup(self):
+        return self.rhs
+
+    def as_sql(self, qn, connection):
+        lhs, lhs_params = self.process_lhs(qn, connection)
+        return '%s %s %%s' % (lhs, self.operator), lhs_params + [self.prepare_value(self.rhs)]
+
+    def prepare_value(self, value):
+        return value
+
+
+class HStoreHasKey(HStoreOperatorLookup):
+    lookup_name = 'has_key'
+    operator = '?'
+
+    def prepare_value(self, value):
+        if not isinstance(value, six.string_types):
+            raise ValueError('invalid value')
+        return value
+
+
+class HStoreHasKeys(HStoreOperatorLookup):
+    lookup_name = 'has_keys'
+    operator = '?&'
+
+    def prepare_value(self, value):
+        if not isinstance(value, (list, tuple)) or not value:
+            raise ValueError('invalid value')
+        return list(value)
+
+
+class HStoreHasAnyKeys(HStoreHasKeys):
+    lookup_name = 'has_any_keys'
+    operator = '?|'
+
+
+class HStoreContainedBy(HStoreOperatorLookup):
+    lookup_name = 'contained_by'
+    operator = '<@'
+
+    def prepare_value(self, value):
+        if not isinstance(value, dict):
+            raise ValueError('invalid value')
+        return self.lhs.output_field.get_prep_value(value)
+
+
+class KeyTransform(Transform):
+    """
+    The value of a key, as in ``filter(data__color='red')``,
+    cast to the type declared for the key in the field.
+    """
+
+    def __init__(self, key, cast, *args, **kwargs):
+        super(KeyTransform, self).__init__(*args, **kwargs)
+        self.key = key
+        self.cast = cast
+
+    def as_sql(self, qn, connection):
+        lhs, params = qn.compile(self.lhs)
+        return key_expression(lhs, self.cast), params + [self.key]
+
+    @property
+    def output_field(self):
+        return TextField()
+
+    def relabeled_clone(self, relabels):
+        return self.__class__(self.key, self.cast, self.lhs.relabeled_clone(relabels), self.init_lookups)
+
+
+class KeyTransformFactory(object):
+
+    def __init__(self, key, cast=None):
+        self.key = key
+        self.cast = cast
+
+    def __call__(self, *args, **kwargs):
+        return KeyTransform(self.key, self.cast, *args, **kwargs)
+
+
+class KeyComparisonLookupMixin(object):
+    """
+    Mixin for the comparisons of the value of a key, as in
+    ``filter(data__rating__gt=3)``, which repeat the condition
+    of the partial index on the key so that the planner can use it.
+    """
+
+    def as_sql(self, qn, connection):
+        sql, params = super(KeyComparisonLookupMixin, self).as_sql(qn, connection)
+        transform = self.lhs
+        if transform.key in getattr(transform.lhs.output_field, 'partial_index_keys', ()):
+            lhs, lhs_params = qn.compile(transform.lhs)
+            sql = '(%s ? %%s AND %s)' % (lhs, sql)
+            params = lhs_params + [transform.key] + list(params)
+        return sql, params
+
+
+class KeyGreaterThan(KeyComparisonLookupMixin, GreaterThan):
+    pass
+
+
+class KeyGreaterThanOrEqual(KeyComparisonLookupMixin, GreaterThanOrEqual):
+    pass
+
+
+class KeyLessThan(KeyComparisonLookupMixin, LessThan):
+    pass
+
+
+class KeyLessThanOrEqual(KeyComparisonLookupMixin, LessThanOrEqual):
+    pass
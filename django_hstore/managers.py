@@ -26,12 +26,45 @@ class HStoreManager(models.Manager):
     def hkeys(self, attr, **params):
         return self.filter(**params).hkeys(attr)
 
+    def hkeys_distinct(self, attr, sample=None, **params):
+        return self.filter(**params).hkeys_distinct(attr, sample)
+
+    def hkey_counts(self, attr, sample=None, **params):
+        return self.filter(**params).hkey_counts(attr, sample)
+
     def hpeek(self, attr, key, **params):
         return self.filter(**params).hpeek(attr, key)
 
     def hslice(self, attr, keys, **params):
         return self.filter(**params).hslice(attr, keys)
 
+    def hvalues_list(self, attr, keys, flat=False, **params):
+        return self.filter(**params).hvalues_list(attr, keys, flat)
+
+    def hslice_values(self, attr, keys, **params):
+        return self.filter(**params).hslice_values(attr, keys)
+
+    def hsum(self, attr, key, cast='numeric', group_by=None, **params):
+        return self.filter(**params).hsum(attr, key, cast, group_by)
+
+    def havg(self, attr, key, cast='numeric', group_by=None, **params):
+        return self.filter(**params).havg(attr, key, cast, group_by)
+
+    def hmin(self, attr, key, cast='numeric', group_by=None, **params):
+        return self.filter(**params).hmin(attr, key, cast, group_by)
+
+    def hmax(self, attr, key, cast='numeric', group_by=None, **params):
+        return self.filter(**params).hmax(attr, key, cast, group_by)
+
+    def hcount(self, attr, key, group_by=None, **params):
+        return self.filter(**params).hcount(attr, key, group_by)
+
+    def prefetch_references(self, *attrs):
+        return self.get_queryset().prefetch_references(*attrs)
+
+    def bulk_upsert(self, objs, conflict_fields, merge='right', update_fields=(), batch_size=1000):
+        return self.get_queryset().bulk_upsert(objs, conflict_fields, merge, update_fields, batch_size)
+
 
 if GEODJANGO_INSTALLED:
     class HStoreGeoManager(geo_models.GeoManager, HStoreManager):
@@ -0,0 +1,54 @@
+from __future__ import unicode_literals, absolute_import
+
+import logging
+
+from django.db import connections
+
+from .explain import explain, _re_operator
+
+
+__all__ = [
+    'HStoreExplainMiddleware'
+]
+
+
+logger = logging.getLogger('django_hstore')
+
+
+class HStoreExplainMiddleware(object):
+    """
+    Explains the queries with hstore conditions executed while
+    processing each request, logging a warning for each sequential scan
+    caused by them. Queries are recorded only when DEBUG is True.
+    """
+
+    def process_request(self, request):
+        request._hstore_queries_start = dict(
+            (connection.alias, len(connection.queries)) for connection in self._connections()
+        )
+
+    def process_response(self, request, response):
+        start = getattr(request, '_hstore_queries_start', None)
+        if start is None:
+            return response
+        for connection in self._connections():
+            queries = connection.queries[start.get(connection.alias, 0):]
+            for query in queries:
+                self.explain_query(connection, query['sql'])
+        return response
+
+    def explain_query(self, connection, sql):
+        # updates and deletes are explained without being executed
+        if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')) or not _re_operator.search(sql):
+            return
+        try:
+            explanation = explain(connection, sql)
+        except Exception:
+            logger.debug('could not explain query: %s', sql, exc_info=True)
+            return
+        for scan in explanation.seq_scans:
+            logger.warning('sequential scan on %s caused by %s: %s', scan['relation'],
+                           ', '.join(scan['operators']), sql)
+
+    def _connections(self):
+        return [connection for connection in connections.all() if connection.vendor == 'postgresql']
@@ -0,0 +1,38 @@
+import re
+
+
+__all__ = [
+    'parse_hstore'
+]
+
+
+# a pair of the text representation returned by the hstore output function:
+# "key"=>"value" or "key"=>NULL, in which quotes and backslashes are escaped
+_re_pair = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"\s*=>\s*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|(NULL))')
+_re_escape = re.compile(r'\\(.)')
+
+
+def parse_hstore(text):
+    """
+    Parses the text representation of an hstore returned by
+    the database into a dictionary. The text is trusted to be
+    well formed, which saves checking the position of each pair.
+    """
+    pairs = _re_pair.findall(text)
+    if not pairs and text.strip():
+        raise ValueError('invalid hstore representation: %r' % text[:100])
+
+    # most dictionaries contain no escaped characters and no NULL values
+    if '\\' not in text and 'NULL' not in text:
+        return dict((key, value) for key, value, null in pairs)
+
+    result = {}
+    for key, value, null in pairs:
+        if '\\' in key:
+            key = _re_escape.sub(r'\1', key)
+        if null:
+            value = None
+        elif '\\' in value:
+            value = _re_escape.sub(r'\1', value)
+        result[key] = value
+    return result
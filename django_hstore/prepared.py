@@ -0,0 +1,163 @@
+from __future__ import unicode_literals, absolute_import
+
+import itertools
+import re
+import weakref
+from decimal import Decimal
+
+from psycopg2 import Error
+from psycopg2.extensions import cursor
+
+from .explain import _re_operator
+
+
+__all__ = [
+    'PreparedStatementCursor',
+    'use_prepared_statements'
+]
+
+
+# maximum number of statements prepared on each connection
+MAX_PREPARED_STATEMENTS = 256
+
+# statements which can be prepared
+_re_statement = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+_re_placeholder = re.compile(r'%%|%s')
+
+# statements with hstore conditions of each connection
+connection_statements = weakref.WeakKeyDictionary()
+
+
+class PreparedStatements(dict):
+    """
+    Names of the prepared statements of a connection by sql,
+    None for the statements which could not be prepared.
+    """
+    prepared = 0
+
+
+def to_positional(sql):
+    """
+    returns the sql with the %s placeholders replaced by the $1, $2...
+    parameters of prepared statements, and the number of parameters
+    """
+    numbers = itertools.count(1)
+
+    def replace(match):
+        return '%' if match.group() == '%%' else '$%d' % next(numbers)
+
+    sql = _re_placeholder.sub(replace, sql)
+    return sql, next(numbers) - 1
+
+
+def parameter_type(param):
+    """
+    returns the type declared for a parameter of a prepared statement:
+    the type of the parameters is inferred from the statement otherwise,
+    and the values of the following executions are converted to it,
+    eg: a float compared with a value cast to integer would be rounded
+    """
+    if isinstance(param, float):
+        return 'double precision'
+    if isinstance(param, Decimal):
+        return 'numeric'
+    return 'unknown'
+
+
+class PreparedStatementCursor(cursor):
+    """
+    Cursor which prepares the statements with hstore conditions the first
+    time they are executed on its connection, and executes the prepared
+    statements afterwards, so that they are parsed and planned only once.
+    Keys are query parameters, hence the statements of the hstore lookups
+    depend only on the number of keys and on their casts.
+    """
+    _executed = None
+
+    def execute(self, sql, params=None):
+        name = None
+        # server side cursors declare their query
+        if self.name is None and isinstance(params, (list, tuple)) and params:
+            name = self._prepared_statement(sql, params)
+        if name is None:
+            self._executed = None
+            return super(PreparedStatementCursor, self).execute(sql, params)
+        self._executed = (sql, params)
+        return super(PreparedStatementCursor, self).execute(
+            'EXECUTE %s(%s)' % (name, ', '.join(['%s'] * len(params))), params
+        )
+
+    @property
+    def query(self):
+        # the query which was prepared rather than the EXECUTE statement
+        if self._executed is not None:
+            return self.mogrify(*self._executed)
+        return super(PreparedStatementCursor, self).query
+
+    def _prepared_statement(self, sql, params):
+        statements = connection_statements.get(self.connection)
+        if statements is None:
+            statements = connection_statements[self.connection] = PreparedStatements()
+        types = tuple(parameter_type(param) for param in params)
+        key = (sql, types)
+        try:
+            return statements[key]
+        except KeyError:
+            pass
+        # only the statements with hstore conditions are prepared and cached,
+        # up to MAX_PREPARED_STATEMENTS prepared and as many failed ones
+        if not _re_statement.match(sql) or not _re_operator.search(sql) or \
+                statements.prepared >= MAX_PREPARED_STATEMENTS:
+            return None
+        name = None
+        positional, number = to_positional(sql)
+        if number == len(params):
+            name = 'django_hstore_%d' % statements.prepared
+            try:
+                if not self._prepare(name, positional, types):
+                    name = None
+            except Error:
+                # the savepoint failed, eg: the transaction is aborted
+                # and the statement itself will fail, do not cache it
+                return None
+        if name is not None:
+            statements.prepared += 1
+            statements[key] = name
+        elif len(statements) - statements.prepared < MAX_PREPARED_STATEMENTS:
+            statements[key] = None
+        return name
+
+    def _prepare(self, name, sql, types):
+        """
+        returns whether the statement has been prepared,
+        the errors of the savepoint are raised
+        """
+        execute = super(PreparedStatementCursor, self).execute
+        prepare = 'PREPARE %s (%s) AS %s' % (name, ', '.join(types), sql)
+        if self.connection.autocommit:
+            try:
+                execute(prepare)
+            except Error:
+                return False
+            return True
+        # parameters whose type cannot be inferred fail the statement,
+        # which must not abort the transaction
+        execute('SAVEPOINT django_hstore_prepare')
+        try:
+            execute(prepare)
+        except Error:
+            execute('ROLLBACK TO SAVEPOINT django_hstore_prepare')
+            return False
+        finally:
+            execute('RELEASE SAVEPOINT django_hstore_prepare')
+        return True
+
+
+def use_prepared_statements(connection):
+    """
+    makes the cursors of the specified django connection prepare
+    the statements with hstore conditions
+    """
+    if connection.connection is None:
+        connection.cursor().close()
+    connection.connection.cursor_factory = PreparedStatementCursor
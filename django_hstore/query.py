@@ -1,15 +1,30 @@
 from __future__ import unicode_literals, absolute_import
 
+import copy
+import sys
+import uuid
+from contextlib import contextmanager
+
 from django import VERSION
-from django.db import transaction
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
 from django.utils import six
+from django.db.models import AutoField
 from django.db.models.query import QuerySet
-from django.db.models.sql.constants import SINGLE
+from django.db.models.sql.constants import MULTI, SINGLE
+try:
+    from django.db.models.sql.constants import CURSOR  # django >= 1.7
+except ImportError:
+    CURSOR = None
 from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.sql.query import Query
 from django.db.models.sql.subqueries import UpdateQuery
 from django.db.models.sql.where import EmptyShortCircuit, WhereNode
 
+from .dict import HStoreReferenceDict, RawHStore, resolve_references
+from .explain import HStoreExplanation, explain
+from . import utils
+
 try:
     from django.contrib.gis.db.models.query import GeoQuerySet
     from django.contrib.gis.db.models.sql.query import GeoQuery
@@ -34,6 +49,76 @@ except ImportError:
     from django.db.models.sql.where import QueryWrapper  # django <= 1.3
 
 
+@contextmanager
+def server_side_cursor(using):
+    """
+    Opens a named cursor on the specified database,
+    the rows it returns are kept on the server until they are fetched.
+    In autocommit mode the cursor is declared WITH HOLD outside of any
+    transaction, the server computes all its rows when it is opened;
+    otherwise the cursor lives in the current transaction.
+    """
+    connection = connections[using]
+    # ensure the connection is open
+    connection.cursor()
+    name = 'django_hstore_%s' % uuid.uuid4().hex
+    # django >= 1.6 runs in autocommit mode outside of atomic blocks
+    if hasattr(connection, 'get_autocommit') and connection.get_autocommit():
+        cursor = connection.connection.cursor(name=name, withhold=True)
+    else:
+        cursor = connection.connection.cursor(name=name)
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def fetch_batches(using, sql, params, batch_size, batch_bytes):
+    """
+    Generator of the batches of rows returned by a named cursor.
+    The size of the batches is adapted to the bytes taken by the
+    values of the rows fetched so far, in order to keep each batch
+    smaller than batch_bytes.
+    """
+    with server_side_cursor(using) as cursor:
+        cursor.execute(sql, params)
+        size = min(batch_size, 100)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            row_bytes = max(sum(values_size(row) for row in rows) // len(rows), 1)
+            size = max(min(batch_size, batch_bytes // row_bytes), 1)
+            try:
+                yield rows
+            except GeneratorExit:
+                # stopping the iteration early is not an error
+                return
+
+
+def values_size(values):
+    """
+    Estimates the memory taken by the values of a row,
+    including the keys and the values of hstore dictionaries.
+    """
+    size = 0
+    for value in values:
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            for key, item in value.items():
+                size += sys.getsizeof(key) + sys.getsizeof(item)
+    return size
+
+
+def check_pg_version(using, version, feature):
+    """
+    raises ImproperlyConfigured if the postgresql server of the
+    specified database is older than version, eg: 90500 for 9.5
+    """
+    if connections[using].pg_version < version:
+        raise ImproperlyConfigured('%s requires postgresql >= %d.%d' % (feature, version // 10000, version // 100 % 100))
+
+
 def select_query(method):
 
     def selector(self, *args, **params):
@@ -45,17 +130,45 @@ def select_query(method):
     return selector
 
 
-def update_query(method):
+# expressions merging the stored hstore with the inserted one by bulk_upsert:
+#   * "right": the inserted values win
+#   * "left": the stored values win
+#   * "delete": the inserted values win, the keys inserted with None values are deleted
+UPSERT_MERGE_POLICIES = {
+    'right': '%(stored)s || %(inserted)s',
+    'left': '%(inserted)s || %(stored)s',
+    'delete': 'delete(%(stored)s || %(inserted)s, ARRAY(SELECT key FROM each(%(inserted)s) WHERE value IS NULL))'
+}
+
 
-    def updater(self, *args, **params):
+def update_query(method):
+    """
+    executes in a transaction either the returned UpdateQuery
+    or the returned list of (sql, params) statements; decorated methods
+    take the name of the hstore field first and accept a returning
+    keyword argument, which makes them return the rows of the returning
+    columns instead of the number of updated rows
+    """
+
+    def updater(self, attr, *args, **params):
+        returning = params.pop('returning', None)
         self._for_write = True
-        query = method(self, self.query.clone(UpdateQuery), *args, **params)
+        query = method(self, self.query.clone(UpdateQuery), attr, *args, **params)
         forced_managed = False
         if not transaction.is_managed(using=self.db):
             transaction.enter_transaction_management(using=self.db)
             forced_managed = True
         try:
-            rows = query.get_compiler(self.db).execute_sql(None)
+            if returning is not None:
+                rows = self._update_returning(query, attr, returning)
+            elif isinstance(query, UpdateQuery):
+                rows = query.get_compiler(self.db).execute_sql(CURSOR)
+            else:
+                rows = 0
+                cursor = connections[self.db].cursor()
+                for sql, sql_params in query:
+                    cursor.execute(sql, sql_params)
+                    rows += cursor.rowcount
             if forced_managed:
                 transaction.commit(using=self.db)
             else:
@@ -92,26 +205,13 @@ class HStoreWhereNode(WhereNode):
 
             elif lookup_type in ('gt', 'gte', 'lt', 'lte'):
                 if isinstance(param, dict):
-                    sign = (lookup_type[0] == 'g' and '>%s' or '<%s') % (lookup_type[-1] == 'e' and '=' or '')
-                    param_keys = list(param.keys())
-                    conditions = []
-
-                    for key in param_keys:
-                        conditions.append('(%s->\'%s\') %s %%s' % (field, key, sign))
-
-                    return (" AND ".join(conditions), param.values())
+                    return utils.get_comparison_sql(field, child[0].field, param, lookup_type)
 
                 raise ValueError('invalid value')
 
             elif lookup_type in ['contains', 'icontains']:
                 if isinstance(param, dict):
-                    values = list(param.values())
-                    keys = list(param.keys())
-
-                    if len(values) == 1 and isinstance(values[0], (list, tuple)):
-                        return ('%s->\'%s\' = ANY(%%s)' % (field, keys[0]), [[str(x) for x in values[0]]])
-
-                    return ('%s @> %%s' % field, [param])
+                    return utils.get_contains_sql(field, child[0].field, param)
 
                 elif isinstance(param, (list, tuple)):
                     if len(param) == 0:
@@ -159,14 +259,49 @@ if GEODJANGO_INSTALLED:
             return HStoreWhereNode.make_atom(self, child, qn, connection)
 
 
-class HStoreQuery(Query):
+class StreamingQueryMixin(object):
+    """
+    Fetches the rows through a named cursor when stream_batches is set
+    to a (batch_size, batch_bytes) tuple. The attribute is not cloned.
+    """
+    stream_batches = None
+
+    def get_compiler(self, using=None, connection=None):
+        compiler = super(StreamingQueryMixin, self).get_compiler(using, connection)
+        if self.stream_batches:
+            compiler.execute_sql = self.streaming_execute_sql(compiler)
+        return compiler
+
+    def streaming_execute_sql(self, compiler):
+        execute_sql = compiler.execute_sql
+        batch_size, batch_bytes = self.stream_batches
+
+        def execute(result_type=MULTI):
+            if result_type != MULTI:
+                return execute_sql(result_type)
+            try:
+                sql, params = compiler.as_sql()
+                if not sql:
+                    raise EmptyResultSet
+            except EmptyResultSet:
+                return iter([])
+            batches = fetch_batches(compiler.using, sql, params, batch_size, batch_bytes)
+            if compiler.ordering_aliases:
+                trim = len(compiler.ordering_aliases)
+                return ([row[:-trim] for row in rows] for rows in batches)
+            return batches
+
+        return execute
+
+
+class HStoreQuery(StreamingQueryMixin, Query):
 
     def __init__(self, model):
         super(HStoreQuery, self).__init__(model, HStoreWhereNode)
 
 
 if GEODJANGO_INSTALLED:
-    class HStoreGeoQuery(GeoQuery, Query):
+    class HStoreGeoQuery(StreamingQueryMixin, GeoQuery, Query):
 
         def __init__(self, *args, **kwargs):
             model = kwargs.pop('model', None) or args[0]
@@ -178,6 +313,80 @@ class HStoreQuerySet(QuerySet):
     def __init__(self, model=None, query=None, using=None, *args, **kwargs):
         query = query or HStoreQuery(model)
         super(HStoreQuerySet, self).__init__(model=model, query=query, using=using, *args, **kwargs)
+        self._prefetch_references = []
+
+    def _clone(self, *args, **kwargs):
+        clone = super(HStoreQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_references = self._prefetch_references[:]
+        return clone
+
+    def iterator(self):
+        if not self._prefetch_references:
+            return super(HStoreQuerySet, self).iterator()
+
+        objects = list(super(HStoreQuerySet, self).iterator())
+        return iter(self._resolve_references(objects))
+
+    def stream(self, batch_size=1000, batch_bytes=8 * 1024 * 1024):
+        """
+        Iterates the objects fetching them from the server through a
+        named cursor, at most batch_size rows at a time and fewer if the
+        batch would take more than batch_bytes, so that memory usage
+        does not grow with the number of rows. No transaction is opened:
+        in autocommit mode the cursor is held across transactions, and
+        the writes made while iterating are committed as usual.
+        """
+        clone = self._clone()
+        clone.query.stream_batches = (batch_size, batch_bytes)
+        objects = super(HStoreQuerySet, clone).iterator()
+        if not self._prefetch_references:
+            return objects
+        return self._resolve_batches(objects, batch_size)
+
+    def _resolve_batches(self, objects, batch_size):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) == batch_size:
+                for obj in self._resolve_references(batch):
+                    yield obj
+                batch = []
+        for obj in self._resolve_references(batch):
+            yield obj
+
+    def _resolve_references(self, objects):
+        for attr in self._prefetch_references:
+            resolve_references([
+                getattr(obj, attr) for obj in objects
+                if isinstance(getattr(obj, attr), HStoreReferenceDict)
+            ])
+        return objects
+
+    def explain_hstore(self, analyze=False):
+        """
+        Explains the query of this queryset, which is also executed if
+        analyze is True. The returned HStoreExplanation lists the
+        sequential scans caused by hstore conditions and the indexes used.
+        """
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            # the queryset matches no rows, no query is executed
+            return HStoreExplanation(None, [])
+        return explain(connections[self.db], sql, params, analyze)
+
+    def prefetch_references(self, *attrs):
+        """
+        Resolves the references stored in the specified ReferencesFields
+        of all the objects in the result set, performing one query for
+        each referenced model. Pass None to clear the list.
+        """
+        clone = self._clone()
+        if attrs == (None,):
+            clone._prefetch_references = []
+        else:
+            clone._prefetch_references.extend(attrs)
+        return clone
 
     @select_query
     def hkeys(self, query, attr):
@@ -188,6 +397,120 @@ class HStoreQuerySet(QuerySet):
         result = query.get_compiler(self.db).execute_sql(SINGLE)
         return (result[0] if result else [])
 
+    @select_query
+    def hkeys_distinct(self, query, attr, sample=None):
+        """
+        Enumerates the distinct keys in the specified hstore of all the rows.
+        If sample is given only that percentage of the table is scanned.
+        """
+        return sorted(key for key, count in self._hkey_rows(query, attr, sample, distinct=True))
+
+    @select_query
+    def hkey_counts(self, query, attr, sample=None):
+        """
+        Counts the rows containing each key of the specified hstore.
+        If sample is given only that percentage of the table is scanned,
+        and the counts are estimated scaling the counts of the sample.
+        """
+        if sample is None:
+            return dict(self._hkey_rows(query, attr))
+        return dict((key, int(round(count * 100.0 / sample))) for key, count in self._hkey_rows(query, attr, sample))
+
+    def _hkey_rows(self, query, attr, sample=None, distinct=False, itersize=2000):
+        qn = connections[self.db].ops.quote_name
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.clear_ordering(force_empty=True)
+        query.add_extra({'_': 'skeys(%s)' % self._quoted_column(field)}, None, None, None, None, None)
+        try:
+            sql, params = query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return []
+
+        if sample is not None:
+            if not 0 < sample <= 100:
+                raise ValueError('sample must be a percentage greater than 0 and at most 100')
+            check_pg_version(self.db, 90500, 'TABLESAMPLE')
+            table = qn(self.model._meta.db_table)
+            sql = sql.replace(' FROM %s' % table, ' FROM %s TABLESAMPLE SYSTEM (%f)' % (table, sample), 1)
+
+        if distinct:
+            sql = 'SELECT DISTINCT "_", NULL FROM (%s) AS "hstore_keys"' % sql
+        else:
+            sql = 'SELECT "_", COUNT(*) FROM (%s) AS "hstore_keys" GROUP BY "_"' % sql
+
+        # the keys of large tables are fetched in batches
+        with server_side_cursor(self.db) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(sql, params)
+            return list(cursor)
+
+    @select_query
+    def hsum(self, query, attr, key, cast='numeric', group_by=None):
+        """
+        Sums the values of the specified key, converted to the cast type.
+        If group_by is given returns a dictionary which maps each value
+        of that key to the sum of the rows containing it.
+        """
+        return self._haggregate(query, 'SUM', attr, key, cast, group_by)
+
+    @select_query
+    def havg(self, query, attr, key, cast='numeric', group_by=None):
+        """
+        Averages the values of the specified key, converted to the cast type.
+        """
+        return self._haggregate(query, 'AVG', attr, key, cast, group_by)
+
+    @select_query
+    def hmin(self, query, attr, key, cast='numeric', group_by=None):
+        """
+        Returns the minimum value of the specified key, converted to the cast type.
+        """
+        return self._haggregate(query, 'MIN', attr, key, cast, group_by)
+
+    @select_query
+    def hmax(self, query, attr, key, cast='numeric', group_by=None):
+        """
+        Returns the maximum value of the specified key, converted to the cast type.
+        """
+        return self._haggregate(query, 'MAX', attr, key, cast, group_by)
+
+    @select_query
+    def hcount(self, query, attr, key, group_by=None):
+        """
+        Counts the rows containing the specified key.
+        """
+        return self._haggregate(query, 'COUNT', attr, key, None, group_by)
+
+    def _haggregate(self, query, function, attr, key, cast, group_by):
+        if cast is not None:
+            utils.check_cast(cast)
+        column = self._quoted_column(self.model._meta.get_field_by_name(attr)[0])
+        empty = 0 if function == 'COUNT' else None
+
+        query.clear_ordering(force_empty=True)
+        query.add_extra({'_': '%s -> %%s' % column}, [key], None, None, None, None)
+        if group_by is not None:
+            query.add_extra({'_group': '%s -> %%s' % column}, [group_by], None, None, None, None)
+        try:
+            sql, params = query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return {} if group_by is not None else empty
+
+        value = '"_"::%s' % cast if cast else '"_"'
+        if group_by is not None:
+            sql = 'SELECT "_group", %s(%s) FROM (%s) AS "hstore_values" GROUP BY "_group"' % (function, value, sql)
+        else:
+            sql = 'SELECT %s(%s) FROM (%s) AS "hstore_values"' % (function, value, sql)
+
+        cursor = connections[self.db].cursor()
+        try:
+            cursor.execute(sql, params)
+            if group_by is not None:
+                return dict(cursor.fetchall())
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
     @select_query
     def hpeek(self, query, attr, key):
         """
@@ -208,9 +531,96 @@ class HStoreQuerySet(QuerySet):
         result = query.get_compiler(self.db).execute_sql(SINGLE)
         if result and result[0]:
             field = self.model._meta.get_field_by_name(attr)[0]
-            return dict((key, field._value_to_python(value)) for key, value in result[0].items())
+            values = result[0].parse() if isinstance(result[0], RawHStore) else result[0]
+            return dict((key, field._value_to_python(value)) for key, value in values.items())
         return {}
 
+    @select_query
+    def hvalues_list(self, query, attr, keys, flat=False):
+        """
+        Iterates the values of the specified keys in each row, as tuples
+        or as single values if flat is True and only one key is given.
+        """
+        if flat and len(keys) > 1:
+            raise TypeError("'flat' is not valid when hvalues_list is called with more than one key.")
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.add_extra({'_': '%s -> %%s::text[]' % self._quoted_column(field)}, [list(keys)],
+                        None, None, None, None)
+        return (row[0] if flat else tuple(row) for row in self._iterate_values(query, field, [None] * len(keys)))
+
+    @select_query
+    def hslice_values(self, query, attr, keys):
+        """
+        Iterates the dictionaries of the specified key/value pairs in each row.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        query.add_extra({'_': 'slice(%s, %%s::text[])' % self._quoted_column(field)}, [list(keys)],
+                        None, None, None, None)
+        return self._iterate_values(query, field, {})
+
+    def _quoted_column(self, field):
+        return connections[self.db].ops.quote_name(field.column)
+
+    def _iterate_values(self, query, field, empty):
+        # only the requested values are transferred and converted,
+        # rows whose hstore is NULL give the empty value
+        try:
+            results = query.get_compiler(self.db).results_iter()
+            for (values,) in results:
+                if values is None:
+                    yield copy.copy(empty)
+                    continue
+                if isinstance(values, RawHStore):
+                    values = values.parse()
+                if isinstance(values, dict):
+                    yield dict((key, field._value_to_python(value) if value is not None else None)
+                               for key, value in values.items())
+                else:
+                    yield [field._value_to_python(value) if value is not None else None for value in values]
+        except EmptyResultSet:
+            return
+
+    def _update_returning(self, query, attr, returning):
+        """
+        executes the update adding a RETURNING clause, returning is either
+        a sequence of field names, like in values_list, or a set of keys of
+        attr, returned as dictionaries together with the primary key
+        """
+        opts = self.model._meta
+        qn = connections[self.db].ops.quote_name
+        table = qn(opts.db_table)
+        if isinstance(returning, (set, frozenset)):
+            field = opts.get_field_by_name(attr)[0]
+            columns = ['%s.%s' % (table, qn(opts.pk.column)), 'slice(%s.%s, %%s::text[])' % (table, qn(field.column))]
+            returning_params = [list(returning)]
+        else:
+            fields = [opts.pk if name == 'pk' else opts.get_field_by_name(name)[0] for name in returning]
+            columns = ['%s.%s' % (table, qn(field.column)) for field in fields]
+            returning_params = []
+        returning = ' RETURNING %s' % ', '.join(columns)
+
+        if isinstance(query, UpdateQuery):
+            try:
+                sql, params = query.get_compiler(self.db).as_sql()
+            except EmptyResultSet:
+                return []
+            if not sql:
+                return []
+            query = [(sql, params)]
+
+        rows = []
+        cursor = connections[self.db].cursor()
+        try:
+            for sql, params in query:
+                cursor.execute(sql + returning, tuple(params) + tuple(returning_params))
+                rows.extend(
+                    tuple(value.parse() if isinstance(value, RawHStore) else value for value in row)
+                    for row in cursor.fetchall()
+                )
+        finally:
+            cursor.close()
+        return rows
+
     @update_query
     def hremove(self, query, attr, keys):
         """
@@ -231,6 +641,211 @@ class HStoreQuerySet(QuerySet):
         query.add_update_fields([(field, None, value)])
         return query
 
+    @update_query
+    def hincr(self, query, attr, increments):
+        """
+        Increments the numeric values of the specified keys in the specified
+        hstore by the deltas of the increments dictionary, in the database;
+        missing keys count as 0.
+        """
+        field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
+        column = self._quoted_column(field)
+        items = sorted(increments.items())
+        values = ['(coalesce(%s -> %%s, \'0\')::numeric + %%s)::text' % column] * len(items)
+        params = [[key for key, delta in items]]
+        for key, delta in items:
+            params.extend([key, delta])
+        if items:
+            value = QueryWrapper('%s || hstore(%%s::text[], ARRAY[%s])' % (column, ', '.join(values)), params)
+        else:
+            value = QueryWrapper(column, [])
+        query.add_update_fields([(field, None, value)])
+        return query
+
+    @update_query
+    def hupdate_many(self, query, attr, updates, batch_size=1000):
+        """
+        Updates the specified hstore of each row with its own dictionary,
+        updates is a dictionary which maps primary keys to dictionaries.
+        Rows are updated in batches, each with a single statement.
+        Returns the number of updated rows.
+        """
+        assert query.can_filter(), "Cannot update a query once a slice has been taken."
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        field, model, direct, m2m = opts.get_field_by_name(attr)
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+
+        restriction, restriction_params = '', []
+        # none() querysets (django >= 1.6) have an empty where clause raising EmptyResultSet
+        if hasattr(query, 'is_empty') and query.is_empty():
+            return []
+        if query.where:
+            # update only the rows in this queryset
+            subquery = self.values_list('pk', flat=True).query
+            try:
+                sql, restriction_params = subquery.get_compiler(self.db).as_sql()
+            except EmptyResultSet:
+                return []
+            restriction = ' AND %s.%s IN (%s)' % (table, pk, sql)
+
+        items = list(updates.items())
+        statements = []
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            params = []
+            for key, value in batch:
+                params.extend([opts.pk.get_db_prep_value(key, connection), field.get_prep_value(value)])
+            sql = 'UPDATE %s SET %s = %s.%s || "v"."updates" FROM (VALUES %s) AS "v"("pk", "updates") ' \
+                  'WHERE %s.%s = "v"."pk"%s' % (
+                      table, qn(field.column), table, qn(field.column),
+                      ', '.join(['(%s, %s)'] * len(batch)), table, pk, restriction
+                  )
+            statements.append((sql, params + list(restriction_params)))
+        return statements
+
+    def bulk_upsert(self, objs, conflict_fields, merge='right', update_fields=(), batch_size=1000):
+        """
+        Inserts the specified model instances; the rows which already exist,
+        identified by the unique conflict_fields, get their hstore fields merged
+        with the inserted ones according to the merge policy, and the values of
+        update_fields overwritten. Instances are upserted in batches, each with
+        a single INSERT ... ON CONFLICT statement (postgresql >= 9.5), then get
+        their primary keys and merged dictionaries; when there is nothing to
+        update, the instances of the rows which already exist are left as they
+        are. A batch must not contain two instances with the same conflict_fields.
+        """
+        if merge not in UPSERT_MERGE_POLICIES:
+            raise ValueError('merge policy %s is not one of %s' % (merge, ', '.join(sorted(UPSERT_MERGE_POLICIES))))
+        assert batch_size is None or batch_size > 0
+        opts = self.model._meta
+        if opts.parents:
+            raise ValueError("Can't bulk upsert an inherited model")
+        check_pg_version(self.db, 90500, 'INSERT ... ON CONFLICT')
+        objs = list(objs)
+        if not objs:
+            return objs
+        batch_size = batch_size or len(objs)
+        self._for_write = True
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+
+        conflict = [opts.get_field_by_name(name)[0] for name in conflict_fields]
+        hstore_fields = [field for field in opts.local_concrete_fields
+                         if field.db_type(connection=connection) == 'hstore']
+        merged_fields = [field for field in hstore_fields if field not in conflict]
+
+        updates = []
+        for field in merged_fields:
+            column = qn(field.column)
+            updates.append('%s = %s' % (column, UPSERT_MERGE_POLICIES[merge] % {
+                'stored': "coalesce(%s.%s, '')" % (table, column),
+                'inserted': "coalesce(EXCLUDED.%s, '')" % column
+            }))
+        for name in update_fields:
+            column = qn(opts.get_field_by_name(name)[0].column)
+            updates.append('%s = EXCLUDED.%s' % (column, column))
+        # the conflict fields identify the rows returned by DO NOTHING
+        returning = [opts.pk] + [field for field in hstore_fields if field is not opts.pk]
+        sql = 'INSERT INTO %%s VALUES %%s ON CONFLICT (%s) %s RETURNING %s' % (
+            ', '.join(qn(field.column) for field in conflict),
+            'DO UPDATE SET %s' % ', '.join(updates) if updates else 'DO NOTHING',
+            ', '.join('%s.%s' % (table, qn(field.column)) for field in returning + conflict)
+        )
+
+        # like bulk_create, the primary keys are inserted only for the
+        # instances which have one, the others get them from the sequence
+        groups = (
+            ([obj for obj in objs if obj.pk is not None], opts.local_concrete_fields),
+            ([obj for obj in objs if obj.pk is None],
+             [field for field in opts.local_concrete_fields if not isinstance(field, AutoField)])
+        )
+
+        with (transaction.atomic(using=self.db) if hasattr(transaction, 'atomic')
+              else transaction.commit_on_success(using=self.db)):
+            cursor = connection.cursor()
+            try:
+                for group, fields in groups:
+                    into = '%s (%s)' % (table, ', '.join(qn(field.column) for field in fields))
+                    for start in range(0, len(group), batch_size):
+                        batch = group[start:start + batch_size]
+                        rows = self._upsert_batch(cursor, sql.replace('%s', into, 1), fields, batch)
+                        if not updates:
+                            rows = self._match_inserted_rows(batch, rows, conflict, len(returning))
+                        else:
+                            rows = zip(batch, rows)
+                        self._assign_upserted_rows(cursor, rows, returning, merged_fields, merge == 'delete')
+            finally:
+                cursor.close()
+        return objs
+
+    def _upsert_batch(self, cursor, sql, fields, batch):
+        connection = connections[self.db]
+        values, params = [], []
+        for obj in batch:
+            placeholders = []
+            for field in fields:
+                value = field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+                placeholders.append(field.get_placeholder(value, connection)
+                                    if hasattr(field, 'get_placeholder') else '%s')
+                params.append(value)
+            values.append('(%s)' % ', '.join(placeholders))
+        cursor.execute(sql.replace('%s', ', '.join(values), 1), params)
+        # rows are returned in the order of the values
+        return cursor.fetchall()
+
+    def _match_inserted_rows(self, batch, rows, conflict, start):
+        # DO NOTHING returns only the inserted rows, recognized by the
+        # values of the conflict fields, which never conflict when NULL
+        matched = []
+        rows = iter(rows)
+        row = next(rows, None)
+        for obj in batch:
+            if row is None:
+                break
+            key = tuple(getattr(obj, field.attname) for field in conflict)
+            if None in key or key == tuple(row[start:]):
+                matched.append((obj, row))
+                row = next(rows, None)
+        return matched
+
+    def _assign_upserted_rows(self, cursor, rows, returning, merged_fields, delete_nulls):
+        opts = self.model._meta
+        qn = connections[self.db].ops.quote_name
+        deletions = dict((field, []) for field in merged_fields)
+        for obj, row in rows:
+            if delete_nulls:
+                # the keys inserted with None values are left in the new rows
+                for field in merged_fields:
+                    keys = [key for key, value in (getattr(obj, field.attname) or {}).items() if value is None]
+                    if keys:
+                        deletions[field].append((row[0], keys))
+            for field, value in zip(returning, row):
+                if field in deletions and isinstance(value, (dict, RawHStore)):
+                    value = value.parse() if isinstance(value, RawHStore) else value
+                    value = dict((key, item) for key, item in value.items() if item is not None)
+                setattr(obj, field.attname, value)
+            obj._state.adding = False
+            obj._state.db = self.db
+
+        table = qn(opts.db_table)
+        for field, items in deletions.items():
+            if not items:
+                continue
+            column = qn(field.column)
+            params = []
+            for pk, keys in items:
+                params.extend([pk, keys])
+            cursor.execute(
+                'UPDATE %s SET %s = delete(%s.%s, "v"."keys") FROM (VALUES %s) AS "v"("pk", "keys") '
+                'WHERE %s.%s = "v"."pk" AND %s.%s ?| "v"."keys"' % (
+                    table, column, table, column, ', '.join(['(%s, %s::text[])'] * len(items)),
+                    table, qn(opts.pk.column), table, column
+                ), params
+            )
 
 if GEODJANGO_INSTALLED:
     class HStoreGeoQuerySet(HStoreQuerySet, GeoQuerySet):
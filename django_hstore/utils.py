@@ -1,14 +1,191 @@
 from __future__ import unicode_literals, absolute_import
 
+import re
+
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import six
 
+try:
+    from importlib import import_module
+except ImportError:
+    # python 2.6
+    from django.utils.importlib import import_module
+
+
+def get_json_backend(path=None):
+    """
+    returns the module used to encode and decode json, which must provide
+    json compatible ``loads`` and ``dumps`` functions; defaults to simplejson
+    if installed, to the json module of the standard library otherwise
+    """
+    if path is not None:
+        return import_module(path)
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+    return json
+
+
+# used by HStoreDict, form fields and widgets
+json = get_json_backend(getattr(settings, 'DJANGO_HSTORE_JSON_BACKEND', None))
+
+
+# type names such as numeric, double precision, varchar(32) or numeric(10, 2)
+_re_cast = re.compile(r'^[a-z_][a-z0-9_ ]*(\(\d+(\s*,\s*\d+)?\))?$', re.IGNORECASE)
+
+
+def check_cast(cast):
+    """
+    raises ValueError unless cast is a plain type name,
+    cast types are interpolated into the sql
+    """
+    if not isinstance(cast, six.string_types) or not _re_cast.match(cast):
+        raise ValueError('invalid cast type: %s' % cast)
+    return cast
+
+
+def quote_key(key):
+    """
+    returns key as an sql string literal, for statements which
+    cannot take parameters such as the definitions of indexes
+    """
+    return "'%s'" % key.replace("'", "''")
+
+
+def key_expression(column, cast=None, key='%s'):
+    """
+    returns the sql of the value of a key in the specified hstore column,
+    converted to the cast type if given; the key is a query parameter unless
+    its sql is given. Lookups and indexes use the same expression so that
+    the planner can match them
+    """
+    expression = '(%s->%s)' % (column, key)
+    if cast:
+        expression = '(%s::%s)' % (expression, cast)
+    return expression
+
+
+class Cast(object):
+    """
+    A value compared with the value of a key after converting it
+    to the cast type, eg: ``filter(data__gt={'price': Cast(9, 'numeric')})``
+    """
+    def __init__(self, value, cast):
+        self.value = value
+        self.cast = check_cast(cast)
+
+    def __repr__(self):
+        return 'Cast(%r, %r)' % (self.value, self.cast)
+
+
+def get_contains_sql(lhs, field, param):
+    """
+    returns the sql of the containment of the param dictionary, whose values
+    can be lists of alternative values; all the conditions use the @> operator,
+    served by gin and gist indexes
+    """
+    fixed = {}
+    conditions = []
+    params = []
+
+    for key, value in param.items():
+        if isinstance(value, (list, tuple)):
+            # contains any of the pairs
+            conditions.append('%s @> ANY(%%s::hstore[])' % lhs)
+            params.append([field.get_prep_value({key: item}) for item in value])
+        else:
+            fixed[key] = value
+
+    if fixed or not conditions:
+        conditions.insert(0, '%s @> %%s' % lhs)
+        params.insert(0, field.get_prep_value(fixed))
+
+    return " AND ".join(conditions), params
+
+
+def get_comparison_sql(lhs, field, param, lookup_type):
+    """
+    returns the sql comparing the values of the keys of the hstore lhs with
+    the values of the param dictionary, casting the keys declared in the
+    casts or the indexes of the field and the values wrapped in Cast;
+    keys are passed as parameters, so that the sql depends only on the
+    number of keys and on their casts
+    """
+    sign = (lookup_type[0] == 'g' and '>%s' or '<%s') % (lookup_type[-1] == 'e' and '=' or '')
+    casts = getattr(field, 'casts', None) or {}
+    partial_index_keys = getattr(field, 'partial_index_keys', ())
+    conditions = []
+    params = []
+
+    # sorted keys give the same sql to the same conditions
+    for key, value in sorted(param.items()):
+        cast = casts.get(key)
+        if isinstance(value, Cast):
+            cast, value = value.cast, value.value
+        condition = '%s %s %%s' % (key_expression(lhs, cast), sign)
+        # repeat the condition of the partial index on the key so that the planner can use it
+        if key in partial_index_keys:
+            condition = '(%s ? %%s AND %s)' % (lhs, condition)
+            params.append(key)
+        conditions.append(condition)
+        params.extend([key, value])
+
+    return " AND ".join(conditions), params
+
+
+# how references to models without an alias are stored:
+#   * "path": python path of the model, eg: "myapp.models.Model:1"
+#   * "content_type": id of the content type of the model, eg: "12:1"
+# references stored with any of the encodings can always be acquired
+REFERENCES_ENCODING = getattr(settings, 'DJANGO_HSTORE_REFERENCES_ENCODING', 'path')
+
+# resolution table of the implementation part of references
+reference_models = {}
+reference_aliases = {}
+
+
+def register_reference_alias(model, alias):
+    """
+    stores references to the specified model as "alias:pk"
+    """
+    alias = six.text_type(alias)
+    if not alias or alias.isdigit() or '.' in alias or ':' in alias:
+        raise ValueError('invalid reference alias %s: cannot be a number nor contain "." or ":"' % alias)
+    if reference_models.get(alias, model) is not model:
+        raise ValueError('reference alias %s already registered' % alias)
+    reference_models[alias] = model
+    reference_aliases[model] = alias
+
+
+def get_reference_model(implementation):
+    """
+    returns the model class referenced by the implementation part of a
+    reference, which is either a python path, an alias or a content type id
+    """
+    try:
+        return reference_models[implementation]
+    except KeyError:
+        pass
+
+    if implementation.isdigit():
+        from django.contrib.contenttypes.models import ContentType
+        model = ContentType.objects.get_for_id(int(implementation)).model_class()
+        if model is None:
+            raise ValueError('stale content type %s' % implementation)
+    else:
+        module, sep, attr = implementation.rpartition('.')
+        model = getattr(__import__(module, fromlist=(attr,)), attr)
+
+    reference_models[implementation] = model
+    return model
+
 
 def acquire_reference(reference):
     try:
         implementation, identifier = reference.split(':')
-        module, sep, attr = implementation.rpartition('.')
-        implementation = getattr(__import__(module, fromlist=(attr,)), attr)
+        implementation = get_reference_model(implementation)
         return implementation.objects.get(pk=identifier)
     except ObjectDoesNotExist:
         return None
@@ -16,8 +193,40 @@ def acquire_reference(reference):
         raise ValueError
 
 
+def acquire_references(references):
+    """
+    resolves a dictionary of references performing
+    only one query for each referenced model
+    """
+    identifiers = {}
+    for key, reference in references.items():
+        try:
+            implementation, identifier = reference.split(':')
+        except Exception:
+            raise ValueError
+        identifiers.setdefault(implementation, {})[key] = identifier
+
+    refs = {}
+    for implementation, keys in identifiers.items():
+        try:
+            model = get_reference_model(implementation)
+            pks = dict((key, model._meta.pk.to_python(identifier)) for key, identifier in keys.items())
+            instances = model.objects.in_bulk(list(set(pks.values())))
+        except Exception:
+            raise ValueError
+        for key, pk in pks.items():
+            refs[key] = instances.get(pk)
+    return refs
+
+
 def identify_instance(instance):
     implementation = type(instance)
+    if implementation in reference_aliases:
+        return '%s:%s' % (reference_aliases[implementation], instance.pk)
+    if REFERENCES_ENCODING == 'content_type':
+        from django.contrib.contenttypes.models import ContentType
+        content_type = ContentType.objects.get_for_model(implementation, for_concrete_model=False)
+        return '%s:%s' % (content_type.pk, instance.pk)
     return '%s.%s:%s' % (implementation.__module__, implementation.__name__, instance.pk)
 
 
@@ -45,9 +254,10 @@ def unserialize_references(references):
     if references is None:
         return refs
     for key, reference in references.items():
-        if isinstance(reference, six.string_types):
-            refs[key] = acquire_reference(reference)
-        else:
+        if not isinstance(reference, six.string_types):
             refs[key] = reference
-    else:
-        return refs
+    # acquire all string references at once
+    refs.update(acquire_references(dict(
+        (key, reference) for key, reference in references.items() if key not in refs
+    )))
+    return refs
@@ -11,6 +11,8 @@ GEODJANGO = settings.DATABASES['default']['ENGINE'] == 'django.contrib.gis.db.ba
 __all__ = [
     'Ref',
     'DataBag',
+    'ProxyDataBag',
+    'CastDataBag',
     'NullableDataBag',
     'RefsBag',
     'NullableRefsBag',
@@ -39,6 +41,20 @@ class DataBag(HStoreModel):
     data = hstore.DictionaryField()
 
 
+class ProxyDataBag(DataBag):
+    class Meta:
+        proxy = True
+
+
+class CastDataBag(HStoreModel):
+    name = models.CharField(max_length=32)
+    data = hstore.DictionaryField(casts={'price': 'numeric'}, indexes=[
+        'gin',
+        {'key': 'price', 'cast': 'numeric'},
+        {'key': 'number', 'cast': 'integer', 'partial': True}
+    ])
+
+
 class NullableDataBag(HStoreModel):
     name = models.CharField(max_length=32)
     data = hstore.DictionaryField(null=True)
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 import sys
+import copy
+import logging
 import json
 import pickle
 from decimal import Decimal
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 import django
+import psycopg2.extensions
 
 from django.db import transaction
 from django.db import connection
@@ -13,22 +21,43 @@ from django.db.utils import IntegrityError, DatabaseError
 from django import forms, get_version as get_django_version
 from django.db import models
 from django.core.urlresolvers import reverse
+from django.http import HttpRequest, HttpResponse
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.test import TestCase
 from django.test import SimpleTestCase
 from django.contrib.auth.models import User
-from django.utils.encoding import force_text
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import force_text, force_bytes
+from django.utils import six
 
-from django_hstore import get_version, hstore
+from django_hstore import get_version, hstore, apps
 from django_hstore.forms import DictionaryFieldWidget, ReferencesFieldWidget
 from django_hstore.fields import HStoreDict
+from django_hstore.dict import DatabaseDict, RawHStore
+from django_hstore.parser import parse_hstore
+from django_hstore.indexes import get_index_statements, create_indexes, drop_indexes
+from django_hstore.middleware import HStoreExplainMiddleware
+from django_hstore.explain import _re_operator
 from django_hstore.exceptions import HStoreDictException
-from django_hstore.utils import unserialize_references, serialize_references, acquire_reference
+from django_hstore import utils
+from django_hstore.utils import unserialize_references, serialize_references, acquire_reference, acquire_references, \
+    register_reference_alias
 from django_hstore.virtual import create_hstore_virtual_field
 
 from django_hstore_tests.models import *
 
 
+class OldHStoreDict(dict):
+    """
+    A dictionary pickled like HStoreDict before it had slots.
+    """
+    def __init__(self, value):
+        super(OldHStoreDict, self).__init__(value)
+        self.schema_mode = False
+        self.field = None
+        self.instance = None
+
+
 class TestDictionaryField(TestCase):
     def setUp(self):
         DataBag.objects.all().delete()
@@ -248,6 +277,25 @@ class TestDictionaryField(TestCase):
         self.assertEqual(len(r), 1)
         self.assertEqual(r[0], alpha)
 
+    def test_values_in_subset_querying(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v': '3', 'v2': '4'})
+        r = DataBag.objects.filter(data__contains={'v': ['1', '3'], 'v2': ['3', '4']}).order_by('name')
+        self.assertEqual(list(r), [alpha, gamma])
+        r = DataBag.objects.filter(data__contains={'v': ['2', '3'], 'v2': '4'}).order_by('name')
+        self.assertEqual(list(r), [beta, gamma])
+        self.assertEqual(list(DataBag.objects.filter(data__contains={'v': []})), [])
+        # served by gin indexes
+        sql = str(DataBag.objects.filter(data__contains={'v': ['2', '3'], 'v2': '4'}).query)
+        self.assertIn(' @> ANY(', sql)
+        self.assertNotIn('->', sql)
+        create_indexes(CastDataBag, 'data')
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        explanation = CastDataBag.objects.filter(data__contains={'color': ['red', 'blue']}).explain_hstore()
+        self.assertEqual(explanation.seq_scans, [])
+        self.assertEqual(explanation.indexes, ['django_hstore_tests_castdatabag_data_gin'])
+
     def test_key_value_gt_querying(self):
         alpha, beta = self._create_bags()
         self.assertGreater(beta.data['v'], alpha.data['v'])
@@ -294,6 +342,241 @@ class TestDictionaryField(TestCase):
         r = DataBag.objects.filter(data__lte={'v': beta.data['v']})
         self.assertEqual(len(r), 2)
 
+    def test_key_value_cast_querying(self):
+        alpha = CastDataBag.objects.create(name='alpha', data={'price': '9', 'code': '9'})
+        beta = CastDataBag.objects.create(name='beta', data={'price': '10', 'code': '10'})
+        # declared in the field
+        self.assertEqual(list(CastDataBag.objects.filter(data__gt={'price': 9})), [beta])
+        self.assertEqual(list(CastDataBag.objects.filter(data__lte={'price': '9.5'})), [alpha])
+        sql, params = CastDataBag.objects.filter(data__gt={'price': 9}).query.sql_with_params()
+        self.assertIn('(("django_hstore_tests_castdatabag"."data"->%s)::numeric) > %s', sql)
+        self.assertEqual(params[-2], 'price')
+        # text comparison otherwise
+        self.assertEqual(list(CastDataBag.objects.filter(data__gt={'code': '9'})), [])
+        # per lookup
+        self.assertEqual(list(CastDataBag.objects.filter(data__gt={'code': hstore.Cast(9, 'integer')})), [beta])
+        self.assertEqual(list(CastDataBag.objects.filter(data__gte={'price': hstore.Cast('9', 'text')})), [alpha])
+        self.assertRaises(ValueError, hstore.Cast, 9, 'integer; --')
+        self.assertRaises(ValueError, hstore.DictionaryField, casts={'price': 'numeric)'})
+
+    def test_indexed_key_querying(self):
+        alpha = CastDataBag.objects.create(name='alpha', data={'number': '9'})
+        beta = CastDataBag.objects.create(name='beta', data={'number': '10'})
+        CastDataBag.objects.create(name='gamma', data={})
+        # cast of the index
+        self.assertEqual(list(CastDataBag.objects.filter(data__gt={'number': 9})), [beta])
+        # condition of the partial index
+        sql, params = CastDataBag.objects.filter(data__lt={'number': 10}).query.sql_with_params()
+        self.assertIn('"django_hstore_tests_castdatabag"."data" ? %s AND '
+                      '(("django_hstore_tests_castdatabag"."data"->%s)::integer) < %s', sql)
+        self.assertEqual(params[-3:-1], ('number', 'number'))
+        self.assertEqual(list(CastDataBag.objects.filter(data__lt={'number': 10})), [alpha])
+
+    def test_parameterized_keys(self):
+        alpha = DataBag.objects.create(name='alpha', data={"it's": '1', 'b': '2'})
+        DataBag.objects.create(name='beta', data={"it's": '2', 'b': '1'})
+        self.assertEqual(list(DataBag.objects.filter(data__lt={"it's": '2'})), [alpha])
+        # the sql depends only on the number of keys
+        first = DataBag.objects.filter(data__gt={'a': '1', 'b': '2'}).query.sql_with_params()
+        second = DataBag.objects.filter(data__gt={'b': '1', 'c': '2'}).query.sql_with_params()
+        self.assertEqual(first[0], second[0])
+        self.assertEqual([first[1][-4], first[1][-2]], ['a', 'b'])
+        self.assertNotIn("'b'", second[0])
+
+    def test_prepared_statements(self):
+        from django_hstore import prepared
+        alpha, beta = self._create_bags()
+        factory = connection.connection.cursor_factory
+        prepared.use_prepared_statements(connection)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            count = cursor.fetchone()[0]
+            for value in ('1', '2', '1'):
+                self.assertEqual(len(DataBag.objects.filter(data__gt={'v': value})), 1 if value == '1' else 0)
+            self.assertEqual(list(DataBag.objects.filter(data__contains={'v': '1'})), [alpha])
+            # the same query shape is prepared once
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            self.assertEqual(cursor.fetchone()[0], count + 2)
+            # the prepared query is logged rather than the EXECUTE statement
+            cursor.execute('SELECT name FROM django_hstore_tests_databag WHERE data @> %s', [{'v': '1'}])
+            self.assertEqual(cursor.fetchall(), [('alpha',)])
+            self.assertIn('WHERE data @> ', force_text(cursor.cursor.query))
+            # statements which cannot be prepared are executed as they are,
+            # without aborting the transaction
+            cursor.execute("SELECT %s::hstore ? 'a' AND %s IS NULL", ['a=>1', None])
+            self.assertTrue(cursor.fetchone()[0])
+            self.assertEqual(DataBag.objects.filter(data__contains={'v': '2'}).count(), 1)
+            # ordinary statements are neither cached nor counted
+            for i in range(prepared.MAX_PREPARED_STATEMENTS + 10):
+                cursor.execute('SELECT %%s + %d' % i, [1])
+            statements = prepared.connection_statements[connection.connection]
+            self.assertTrue(all(_re_operator.search(sql) for sql, types in statements))
+            # hstore statements are still prepared
+            self.assertEqual(list(DataBag.objects.filter(data__lt={'v': '2', 'v2': '4'})), [alpha])
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            self.assertEqual(cursor.fetchone()[0], count + 5)
+
+            # the types of float and decimal parameters are declared, instead of being inferred
+            CastDataBag.objects.create(name='alpha', data={'number': '9'})
+            CastDataBag.objects.create(name='beta', data={'number': '10'})
+            sql = 'SELECT name FROM django_hstore_tests_castdatabag WHERE (data -> %s)::integer >= %s ORDER BY name'
+            cursor.execute(sql, ['number', 9])
+            self.assertEqual(cursor.fetchall(), [('alpha',), ('beta',)])
+            cursor.execute(sql, ['number', 9.4])
+            self.assertEqual(cursor.fetchall(), [('beta',)])
+
+            # statements failing because the transaction is aborted are not cached
+            sql = 'SELECT name FROM django_hstore_tests_databag WHERE data ? %s'
+            try:
+                with transaction.atomic():
+                    try:
+                        cursor.execute('SELECT 1 / 0')
+                    except DatabaseError:
+                        pass
+                    cursor.execute(sql, ['v'])
+            except DatabaseError:
+                pass
+            self.assertNotIn((sql, ('unknown',)), statements)
+            cursor.execute(sql, ['v'])
+            self.assertEqual(len(cursor.fetchall()), 2)
+            self.assertIsNotNone(statements[(sql, ('unknown',))])
+        finally:
+            connection.connection.cursor_factory = factory
+        self.assertEqual(prepared.to_positional('SELECT %s, \'%%\', %s'), ('SELECT $1, \'%\', $2', 2))
+
+    def test_explain_hstore(self):
+        self._create_bags()
+        explanation = DataBag.objects.filter(data__contains={'v': '1'}).explain_hstore()
+        self.assertEqual(len(explanation.seq_scans), 1)
+        self.assertEqual(explanation.seq_scans[0]['relation'], 'django_hstore_tests_databag')
+        self.assertEqual(explanation.seq_scans[0]['operators'], ['@>'])
+        self.assertIn('sequential scan on django_hstore_tests_databag caused by @>', str(explanation))
+        explanation = DataBag.objects.filter(data__gt={'v': '1'}, name='alpha').explain_hstore(analyze=True)
+        self.assertEqual(explanation.seq_scans[0]['operators'], ['->'])
+        self.assertIn('Actual Rows', explanation.plan[0]['Plan'])
+        self.assertEqual(DataBag.objects.filter(name='alpha').explain_hstore().seq_scans, [])
+
+        # querysets which match no rows are not executed
+        for queryset in (DataBag.objects.none(), DataBag.objects.filter(pk__in=[], data__contains=['v'])):
+            explanation = queryset.explain_hstore()
+            self.assertEqual(explanation.plan, [])
+            self.assertEqual(explanation.seq_scans, [])
+            self.assertEqual(explanation.indexes, [])
+
+        create_indexes(CastDataBag, 'data')
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        explanation = CastDataBag.objects.filter(data__contains=['price']).explain_hstore()
+        self.assertEqual(explanation.seq_scans, [])
+        self.assertEqual(explanation.indexes, ['django_hstore_tests_castdatabag_data_gin'])
+
+    def test_explain_middleware(self):
+        self._create_bags()
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('django_hstore')
+        logger.addHandler(handler)
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            middleware = HStoreExplainMiddleware()
+            request = HttpRequest()
+            middleware.process_request(request)
+            list(DataBag.objects.filter(data__contains=['v']))
+            list(DataBag.objects.filter(name='alpha'))
+            middleware.process_response(request, HttpResponse())
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            logger.removeHandler(handler)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith('sequential scan on django_hstore_tests_databag caused by ?: '))
+
+    def test_indexes(self):
+        field = CastDataBag._meta.get_field('data')
+        self.assertEqual(field.casts, {'price': 'numeric', 'number': 'integer'})
+        if get_django_version() >= '1.7':
+            # the casts of the indexes are not declared casts
+            name, path, args, kwargs = field.deconstruct()
+            self.assertEqual(kwargs['casts'], {'price': 'numeric'})
+            self.assertEqual(type(field)(*args, **kwargs).casts, field.casts)
+        statements = get_index_statements(CastDataBag, field)
+        self.assertEqual(statements[0][1], 'CREATE INDEX "django_hstore_tests_castdatabag_data_gin" '
+                                           'ON "django_hstore_tests_castdatabag" USING gin ("data")')
+        self.assertTrue(statements[1][1].endswith('ON "django_hstore_tests_castdatabag" '
+                                                  '((("data"->\'price\')::numeric))'))
+        self.assertTrue(statements[2][1].endswith('((("data"->\'number\')::integer)) WHERE "data" ? \'number\''))
+        self.assertTrue(get_index_statements(CastDataBag, field, concurrently=True)[0][1].startswith(
+            'CREATE INDEX CONCURRENTLY'))
+
+        create_indexes(CastDataBag, 'data')
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'django_hstore_tests_castdatabag'")
+        names = set(row[0] for row in cursor.fetchall())
+        self.assertTrue(set(name for name, create, drop in statements) <= names)
+        drop_indexes(CastDataBag, 'data')
+
+        for indexes in ('gin', ['btree'], [{'cast': 'integer'}], [{'key': 'a', 'cast': 'integer;'}],
+                        [{'key': 'a', 'unique': True}]):
+            self.assertRaises(ValueError, hstore.DictionaryField, indexes=indexes)
+
+    if get_django_version()[0:3] >= '1.7':
+        def test_indexes_migration_operation(self):
+            from django.apps import apps as django_apps
+            from django.db.migrations.state import ProjectState
+            from django_hstore.indexes import CreateHStoreIndexes
+
+            operation = CreateHStoreIndexes('castdatabag', 'data')
+            self.assertEqual(operation.describe(), 'Create hstore indexes on castdatabag.data')
+            state = ProjectState.from_apps(django_apps)
+            with connection.schema_editor() as editor:
+                operation.database_forwards('django_hstore_tests', editor, state, state)
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE indexname = 'django_hstore_tests_castdatabag_data_gin'")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            with connection.schema_editor() as editor:
+                operation.database_backwards('django_hstore_tests', editor, state, state)
+            cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE indexname = 'django_hstore_tests_castdatabag_data_gin'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    if get_django_version()[0:3] >= '1.7':
+        def test_key_lookups(self):
+            alpha, beta = self._create_bags()
+            gamma = DataBag.objects.create(name='gamma', data={'v3': '5'})
+            self.assertEqual(list(DataBag.objects.filter(data__has_key='v3')), [gamma])
+            self.assertEqual(list(DataBag.objects.filter(data__has_keys=['v', 'v2']).order_by('name')), [alpha, beta])
+            self.assertEqual(list(DataBag.objects.filter(data__has_keys=['v', 'v3'])), [])
+            self.assertEqual(DataBag.objects.filter(data__has_any_keys=['v', 'v3']).count(), 3)
+            self.assertEqual(list(DataBag.objects.filter(data__contained_by={'v': '1', 'v2': '3', 'v3': '4'})), [alpha])
+            self.assertIn('"django_hstore_tests_databag"."data" ?| ',
+                          str(DataBag.objects.filter(data__has_any_keys=['v']).query))
+            with self.assertRaises(ValueError):
+                list(DataBag.objects.filter(data__has_keys=[]))
+            with self.assertRaises(ValueError):
+                list(DataBag.objects.filter(data__contained_by=['v']))
+
+        def test_key_transforms(self):
+            alpha, beta = self._create_bags()
+            self.assertEqual(list(DataBag.objects.filter(data__v='1')), [alpha])
+            self.assertEqual(list(DataBag.objects.filter(data__v2__gt=3)), [beta])
+            self.assertEqual(list(DataBag.objects.filter(data__v__in=['2', '3'])), [beta])
+            self.assertEqual(list(DataBag.objects.exclude(data__v__contains='1')), [beta])
+            self.assertEqual(DataBag.objects.filter(data__invalid='1').count(), 0)
+            # cast declared in the field
+            CastDataBag.objects.create(name='alpha', data={'price': '9'})
+            beta = CastDataBag.objects.create(name='beta', data={'price': '10'})
+            self.assertEqual(list(CastDataBag.objects.filter(data__price__gt=9)), [beta])
+            self.assertIn('(("django_hstore_tests_castdatabag"."data"->price)::numeric) > 9',
+                          str(CastDataBag.objects.filter(data__price__gt=9).query))
+            # condition of the partial index on the key
+            CastDataBag.objects.create(name='gamma', data={'number': '3'})
+            delta = CastDataBag.objects.create(name='delta', data={'number': '12'})
+            self.assertEqual(list(CastDataBag.objects.filter(data__number__gte=4)), [delta])
+            self.assertIn('("django_hstore_tests_castdatabag"."data" ? number AND '
+                          '(("django_hstore_tests_castdatabag"."data"->number)::integer) >= 4)',
+                          str(CastDataBag.objects.filter(data__number__gte=4).query))
+
     def test_multiple_key_subset_querying(self):
         alpha, beta = self._create_bags()
         for keys in (['v'], ['v', 'v2']):
@@ -355,6 +638,30 @@ class TestDictionaryField(TestCase):
         self.assertEqual(DataBag.objects.hkeys(id=alpha.id, attr='data'), ['v', 'v2'])
         self.assertEqual(DataBag.objects.hkeys(id=beta.id, attr='data'), ['v', 'v2'])
 
+    def test_hkeys_distinct(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': '3', 'v3': '5'})
+        self.assertEqual(DataBag.objects.hkeys_distinct('data'), ['v', 'v2', 'v3'])
+        self.assertEqual(DataBag.objects.hkeys_distinct('data', name='gamma'), ['v', 'v3'])
+        self.assertEqual(DataBag.objects.none().hkeys_distinct('data'), [])
+        if connection.pg_version >= 90500:
+            self.assertEqual(DataBag.objects.hkeys_distinct('data', sample=100), ['v', 'v2', 'v3'])
+        else:
+            self.assertRaises(ImproperlyConfigured, DataBag.objects.hkeys_distinct, 'data', sample=100)
+
+    def test_hkey_counts(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': '3', 'v3': '5'})
+        self.assertEqual(DataBag.objects.hkey_counts('data'), {'v': 3, 'v2': 2, 'v3': 1})
+        self.assertEqual(DataBag.objects.exclude(name='gamma').hkey_counts('data'), {'v': 2, 'v2': 2})
+        self.assertEqual(DataBag.objects.filter(name='delta').hkey_counts('data'), {})
+        self.assertRaises(ValueError, DataBag.objects.hkey_counts, 'data', sample=0)
+        if connection.pg_version >= 90500:
+            self.assertEqual(DataBag.objects.hkey_counts('data', sample=100), {'v': 3, 'v2': 2, 'v3': 1})
+            # the counts of the sample are scaled, a page holds all the rows
+            counts = DataBag.objects.hkey_counts('data', sample=50)
+            self.assertIn(counts, [{}, {'v': 6, 'v2': 4, 'v3': 2}])
+
     def test_hpeek(self):
         alpha, beta = self._create_bags()
         self.assertEqual(DataBag.objects.hpeek(id=alpha.id, attr='data', key='v'), '1')
@@ -377,16 +684,216 @@ class TestDictionaryField(TestCase):
         self.assertEqual(DataBag.objects.filter(id=alpha.id).hslice(attr='data', keys=['v']), {'v': '1'})
         self.assertEqual(DataBag.objects.hslice(id=alpha.id, attr='data', keys=['ggg']), {})
 
+    def test_hvalues_list(self):
+        self._create_bags()
+        queryset = DataBag.objects.order_by('name')
+        self.assertEqual(list(queryset.hvalues_list('data', ['v2', 'v'])), [('3', '1'), ('4', '2')])
+        self.assertEqual(list(queryset.hvalues_list('data', ['v'], flat=True)), ['1', '2'])
+        self.assertEqual(list(queryset.hvalues_list('data', ['invalid'])), [(None,), (None,)])
+        self.assertEqual(list(DataBag.objects.hvalues_list('data', ['v'], flat=True, name='beta')), ['2'])
+        self.assertEqual(list(queryset.none().hvalues_list('data', ['v'])), [])
+        self.assertRaises(TypeError, queryset.hvalues_list, 'data', ['v', 'v2'], flat=True)
+
+    def test_hslice_values(self):
+        self._create_bags()
+        queryset = DataBag.objects.order_by('name')
+        self.assertEqual(list(queryset.hslice_values('data', ['v2', 'invalid'])), [{'v2': '3'}, {'v2': '4'}])
+        self.assertEqual(list(DataBag.objects.hslice_values('data', ['v'], name='alpha')), [{'v': '1'}])
+
+    def test_hvalues_list_null(self):
+        NullableDataBag.objects.create(name='alpha', data=None)
+        NullableDataBag.objects.create(name='beta', data={'v': '1'})
+        queryset = NullableDataBag.objects.order_by('name')
+        self.assertEqual(list(queryset.hvalues_list('data', ['v', 'v2'])), [(None, None), ('1', None)])
+        self.assertEqual(list(queryset.hvalues_list('data', ['v'], flat=True)), [None, '1'])
+        self.assertEqual(list(queryset.hslice_values('data', ['v'])), [{}, {'v': '1'}])
+
+    def test_stream(self):
+        for i in range(25):
+            DataBag.objects.create(name='bag%02d' % i, data={'v': str(i), 'text': 'x' * i})
+        queryset = DataBag.objects.order_by('name')
+        bags = list(queryset.stream(batch_size=10))
+        self.assertEqual([bag.name for bag in bags], list(queryset.values_list('name', flat=True)))
+        self.assertEqual(bags[3].data, {'v': '3', 'text': 'xxx'})
+        self.assertIsInstance(bags[3].data, HStoreDict)
+        # batches of one row
+        self.assertEqual(len(list(queryset.stream(batch_bytes=1))), 25)
+        self.assertEqual(list(queryset.filter(name='bag03').stream()), [bags[3]])
+        self.assertEqual(list(queryset.none().stream()), [])
+        # stopping early does not roll back
+        next(queryset.stream())
+        DataBag.objects.create(name='last')
+        self.assertEqual(DataBag.objects.filter(name='last').count(), 1)
+
+    def test_hstore_aggregates(self):
+        DataBag.objects.create(name='alpha', data={'amount': '10', 'kind': 'a'})
+        DataBag.objects.create(name='beta', data={'amount': '2.5', 'kind': 'b'})
+        DataBag.objects.create(name='gamma', data={'amount': '7', 'kind': 'a'})
+        DataBag.objects.create(name='delta', data={'kind': 'b'})
+        self.assertEqual(DataBag.objects.hsum('data', 'amount'), Decimal('19.5'))
+        self.assertEqual(DataBag.objects.havg('data', 'amount', cast='float'), 6.5)
+        self.assertEqual(DataBag.objects.hmin('data', 'amount'), Decimal('2.5'))
+        self.assertEqual(DataBag.objects.hmax('data', 'amount', cast='text'), '7')
+        self.assertEqual(DataBag.objects.hcount('data', 'amount'), 3)
+        # composed with filters
+        self.assertEqual(DataBag.objects.filter(data__contains={'kind': 'a'}).hsum('data', 'amount'), 17)
+        self.assertEqual(DataBag.objects.hsum('data', 'amount', name='beta'), Decimal('2.5'))
+        self.assertEqual(DataBag.objects.filter(name='invalid').hsum('data', 'amount'), None)
+        self.assertEqual(DataBag.objects.none().hcount('data', 'amount'), 0)
+        # grouped by another key
+        self.assertEqual(DataBag.objects.hsum('data', 'amount', group_by='kind'),
+                         {'a': Decimal('17'), 'b': Decimal('2.5')})
+        self.assertEqual(DataBag.objects.hcount('data', 'amount', group_by='kind'), {'a': 2, 'b': 1})
+        self.assertRaises(ValueError, DataBag.objects.hsum, 'data', 'amount', cast='numeric); DROP TABLE x; --')
+
     def test_hupdate(self):
         alpha, beta = self._create_bags()
         self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
         DataBag.objects.filter(name='alpha').hupdate('data', {'v2': '10', 'v3': '20'})
         self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '20'})
 
+    def test_hupdate_many(self):
+        alpha, beta = self._create_bags()
+        updates = {alpha.pk: {'v2': '10', 'v3': 3}, beta.pk: {'v': '20'}}
+        self.assertEqual(DataBag.objects.all().hupdate_many('data', updates), 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '3'})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '20', 'v2': '4'})
+
+        # rows outside the queryset are not updated
+        self.assertEqual(DataBag.objects.filter(name='alpha').hupdate_many('data', {beta.pk: {'v': '30'}}), 0)
+        self.assertEqual(DataBag.objects.get(name='beta').data['v'], '20')
+
+        # batches
+        self.assertEqual(DataBag.objects.all().hupdate_many('data', updates, batch_size=1), 2)
+        self.assertEqual(DataBag.objects.all().hupdate_many('data', {}), 0)
+        self.assertEqual(DataBag.objects.none().hupdate_many('data', updates), 0)
+        self.assertEqual(DataBag.objects.filter(pk__in=[]).hupdate_many('data', updates), 0)
+        # primary keys are converted to the type of the column
+        self.assertEqual(DataBag.objects.all().hupdate_many('data', {str(alpha.pk): {'v': '40'}}), 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data['v'], '40')
+
+    def test_hincr(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.filter(name='alpha').hincr('data', {'v': 2, 'views': 1}), 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '3', 'v2': '3', 'views': '1'})
+        rows = DataBag.objects.all().hincr('data', {'v2': Decimal('-0.5')}, returning=set(['v2']))
+        self.assertEqual(sorted(rows), sorted([(alpha.pk, {'v2': '2.5'}), (beta.pk, {'v2': '3.5'})]))
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '2', 'v2': '3.5'})
+        self.assertEqual(DataBag.objects.filter(name='beta').hincr('data', {}), 1)
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '2', 'v2': '3.5'})
+
+    def test_bulk_upsert(self):
+        if connection.pg_version < 90500:
+            self.assertRaises(ImproperlyConfigured, DataBag.objects.bulk_upsert, [DataBag()], ['id'])
+            self.skipTest('INSERT ... ON CONFLICT requires postgresql >= 9.5')
+        alpha, beta = self._create_bags()
+        objs = [DataBag(pk=alpha.pk, name='new alpha', data={'v': '10', 'v3': '30'}),
+                DataBag(pk=beta.pk + 100, name='gamma', data={'v': '5'})]
+        self.assertEqual(DataBag.objects.bulk_upsert(objs, ['id']), objs)
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {'v': '10', 'v2': '3', 'v3': '30'})
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).name, 'alpha')
+        self.assertEqual(DataBag.objects.get(pk=beta.pk + 100).data, {'v': '5'})
+        # the instances get the merged dictionaries
+        self.assertEqual(objs[0].data, {'v': '10', 'v2': '3', 'v3': '30'})
+        self.assertFalse(objs[0]._state.adding)
+
+        # stored values win
+        objs = [DataBag(pk=alpha.pk, name='new alpha', data={'v': '20', 'v4': '40'})]
+        DataBag.objects.bulk_upsert(objs, ['id'], merge='left', update_fields=['name'])
+        alpha = DataBag.objects.get(pk=alpha.pk)
+        self.assertEqual(alpha.data, {'v': '10', 'v2': '3', 'v3': '30', 'v4': '40'})
+        self.assertEqual(alpha.name, 'new alpha')
+
+        # None values delete keys
+        objs = [DataBag(pk=alpha.pk, data={'v': '1', 'v2': None, 'v5': None}),
+                DataBag(pk=beta.pk, data={'v2': None})]
+        DataBag.objects.bulk_upsert(objs, ['id'], merge='delete', batch_size=1)
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {'v': '1', 'v3': '30', 'v4': '40'})
+        self.assertEqual(DataBag.objects.get(pk=beta.pk).data, {'v': '2'})
+
+        # new rows get their primary keys
+        objs = [DataBag(name='delta', data={'v': '1'}), DataBag(name='epsilon', data={})]
+        DataBag.objects.bulk_upsert(objs, ['id'])
+        self.assertEqual(DataBag.objects.get(pk=objs[0].pk).name, 'delta')
+        self.assertEqual(DataBag.objects.get(pk=objs[1].pk).name, 'epsilon')
+        self.assertEqual(DataBag.objects.count(), 5)
+
+        # instances with and without primary keys in the same batch
+        objs = [DataBag(name='zeta', data={'v': '7'}), DataBag(pk=beta.pk, name='beta', data={'v3': '3'})]
+        DataBag.objects.bulk_upsert(objs, ['id'])
+        self.assertEqual(DataBag.objects.count(), 6)
+        self.assertEqual(DataBag.objects.get(pk=beta.pk).data, {'v': '2', 'v3': '3'})
+        self.assertEqual(DataBag.objects.get(pk=objs[0].pk).name, 'zeta')
+
+        # None values are not inserted in new rows either
+        objs = [DataBag(name='eta', data={'v': '1', 'v2': None})]
+        DataBag.objects.bulk_upsert(objs, ['id'], merge='delete')
+        self.assertEqual(DataBag.objects.get(pk=objs[0].pk).data, {'v': '1'})
+        self.assertEqual(objs[0].data, {'v': '1'})
+
+        # nothing to update, only the new rows are returned
+        UniqueTogetherDataBag.objects.create(name='alpha', data={'v': '1'})
+        objs = [UniqueTogetherDataBag(name='alpha', data={'v': '1'}),
+                UniqueTogetherDataBag(name='beta', data={'v': '1'})]
+        UniqueTogetherDataBag.objects.bulk_upsert(objs, ['name', 'data'])
+        self.assertIsNone(objs[0].pk)
+        self.assertEqual(UniqueTogetherDataBag.objects.get(pk=objs[1].pk).name, 'beta')
+        self.assertFalse(objs[1]._state.adding)
+        self.assertEqual(UniqueTogetherDataBag.objects.count(), 2)
+
+        self.assertEqual(DataBag.objects.bulk_upsert([], ['id']), [])
+        self.assertRaises(ValueError, DataBag.objects.bulk_upsert, objs, ['id'], merge='replace')
+
+    def test_update_returning(self):
+        alpha, beta = self._create_bags()
+        rows = DataBag.objects.filter(name='alpha').hupdate('data', {'v3': '20'}, returning=('pk', 'data'))
+        self.assertEqual(rows, [(alpha.pk, {'v': '1', 'v2': '3', 'v3': '20'})])
+        rows = DataBag.objects.filter(name='beta').hremove('data', ['v'], returning=('name', 'data'))
+        self.assertEqual(rows, [('beta', {'v2': '4'})])
+        # keys are returned together with the primary key
+        rows = DataBag.objects.all().hupdate('data', {'v': '5'}, returning=set(['v', 'v3']))
+        self.assertEqual(sorted(rows), sorted([(alpha.pk, {'v': '5', 'v3': '20'}), (beta.pk, {'v': '5'})]))
+        rows = DataBag.objects.all().hupdate_many('data', {beta.pk: {'v': '6'}}, returning=('pk',), batch_size=1)
+        self.assertEqual(rows, [(beta.pk,)])
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '6', 'v2': '4'})
+        # no rows
+        self.assertEqual(DataBag.objects.filter(name='gamma').hupdate('data', {'v': '1'}, returning=('pk',)), [])
+        self.assertEqual(DataBag.objects.none().hupdate('data', {'v': '1'}, returning=('pk',)), [])
+
     def test_default(self):
         m = DefaultsModel()
         m.save()
 
+    def test_default_template(self):
+        field = DefaultsModel._meta.get_field('c')
+        template = field.get_default()
+        self.assertEqual(template, {'x': '1'})
+        self.assertTrue(field.get_default() is template)
+        with self.assertRaises(TypeError):
+            template['y'] = '2'
+        with self.assertRaises(TypeError):
+            template.update({'y': '2'})
+        self.assertEqual(pickle.loads(pickle.dumps(template)), template)
+
+        # each instance gets its own copy
+        m1, m2 = DefaultsModel(), DefaultsModel()
+        self.assertEqual(type(m1.c), HStoreDict)
+        m1.c['y'] = '2'
+        self.assertEqual(m1.c, {'x': '1', 'y': '2'})
+        self.assertEqual(m2.c, {'x': '1'})
+        self.assertEqual(m1.a, {})
+        m1.a['z'] = '3'
+        self.assertEqual(DefaultsModel().a, {})
+
+    def test_callable_default(self):
+        field = hstore.DictionaryField(default=lambda: {'a': 1})
+        default = field.get_default()
+        self.assertEqual(default, {'a': '1'})
+        self.assertFalse(field.get_default() is default)
+        # changing a default does not change the following ones
+        default['b'] = '2'
+        self.assertEqual(field.get_default(), {'a': '1'})
+
     def test_bad_default(self):
         m = BadDefaultsModel()
         try:
@@ -580,6 +1087,198 @@ class TestDictionaryField(TestCase):
         d = DataBag()
         self.assertEqual(str(d.data), '{}')
 
+    def test_database_dict(self):
+        alpha, beta = self._create_bags()
+        cursor = connection.cursor()
+        cursor.execute('SELECT data FROM django_hstore_tests_databag WHERE id = %s', [alpha.id])
+        value = cursor.fetchone()[0]
+        self.assertIsInstance(value, DatabaseDict)
+        self.assertEqual(value, {'v': '1', 'v2': '3'})
+
+        alpha = DataBag.objects.get(name='alpha')
+        self.assertEqual(type(alpha.data), HStoreDict)
+        self.assertEqual(alpha.data, {'v': '1', 'v2': '3'})
+
+    def test_changed_keys(self):
+        alpha, beta = self._create_bags()
+        # new dictionaries are not tracked until they're saved
+        self.assertIsNone(DataBag(data={'a': '1'}).data.changed_keys)
+        self.assertEqual(alpha.data.changed_keys, set())
+
+        alpha = DataBag.objects.get(name='alpha')
+        self.assertEqual(alpha.data.changed_keys, set())
+        alpha.data['v'] = 2
+        alpha.data.update({'v3': '3'})
+        del alpha.data['v2']
+        alpha.data.pop('idontexist', None)
+        self.assertEqual(alpha.data.changed_keys, set(['v', 'v2', 'v3']))
+
+        alpha.save()
+        self.assertEqual(alpha.data.changed_keys, set())
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '2', 'v3': '3'})
+
+    def test_changed_keys_proxy_model(self):
+        self._create_bags()
+        alpha = ProxyDataBag.objects.get(name='alpha')
+        alpha.data['v'] = '2'
+        alpha.save()
+        self.assertEqual(alpha.data.changed_keys, set())
+        # keys saved already are not sent again
+        DataBag.objects.filter(name='alpha').hupdate('data', {'v': '3'})
+        alpha.data['v3'] = '3'
+        alpha.save()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '3', 'v2': '3', 'v3': '3'})
+
+    def test_save_changed_keys_only(self):
+        alpha, beta = self._create_bags()
+        alpha = DataBag.objects.get(name='alpha')
+        alpha.data['v'] = '10'
+        del alpha.data['v2']
+        # concurrent update of another key
+        DataBag.objects.filter(name='alpha').hupdate('data', {'other': 'x'})
+        alpha.save()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '10', 'other': 'x'})
+
+        # no changes: value in the database is left untouched
+        DataBag.objects.filter(name='alpha').hupdate('data', {'other': 'y'})
+        alpha.save()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '10', 'other': 'y'})
+
+        # replacing the whole dictionary writes the whole value
+        alpha.data = {'new': '1'}
+        alpha.save()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'new': '1'})
+
+    def test_hstoredict_slots(self):
+        d = DataBag(data={'a': '1'}).data
+        self.assertFalse(hasattr(d, '__dict__'))
+        self.assertFalse(hasattr(HStoreDict(), '__dict__'))
+
+        d = pickle.loads(pickle.dumps(DataBag.objects.create(name='pickle', data={'a': '1'}).data))
+        self.assertEqual(d, {'a': '1'})
+        self.assertEqual(d.field, DataBag._meta.get_field('data'))
+        self.assertEqual(d.changed_keys, set())
+
+    def test_unpickle_dict_state(self):
+        # pickles made before the slots were added carry the attributes in a __dict__
+        payloads = [
+            pickle.dumps(OldHStoreDict({'a': '1'}), protocol).replace(
+                force_bytes('%s\nOldHStoreDict' % OldHStoreDict.__module__), b'django_hstore.dict\nHStoreDict'
+            ) for protocol in (0, 1, 2)
+        ]
+        for payload in payloads:
+            d = pickle.loads(payload)
+            self.assertIsInstance(d, HStoreDict)
+            self.assertEqual(d, {'a': '1'})
+            self.assertFalse(d.schema_mode)
+            d['b'] = 2
+            self.assertEqual(d, {'a': '1', 'b': '2'})
+            self.assertEqual(d.changed_keys, None)
+
+    def test_shared_keys(self):
+        self._create_bags()
+        apps.HSTORE_SHARE_KEYS = True
+        try:
+            alpha, beta = DataBag.objects.order_by('name')
+        finally:
+            apps.HSTORE_SHARE_KEYS = False
+        self.assertEqual(alpha.data, {'v': '1', 'v2': '3'})
+        self.assertEqual(beta.data, {'v': '2', 'v2': '4'})
+        self.assertTrue(sorted(alpha.data)[0] is sorted(beta.data)[0])
+
+    def test_deferred_parsing(self):
+        self._create_bags()
+        apps.HSTORE_DEFERRED_PARSING = True
+        try:
+            alpha = DataBag.objects.get(name='alpha')
+            self.assertIsInstance(alpha.__dict__['data'], RawHStore)
+            self.assertEqual(DataBag.objects.hslice(name='alpha', attr='data', keys=['v']), {'v': '1'})
+            self.assertEqual(list(DataBag.objects.hslice_values('data', ['v'], name='beta')), [{'v': '2'}])
+            beta = DataBag.objects.get(name='beta')
+        finally:
+            apps.HSTORE_DEFERRED_PARSING = False
+        # parsed on first access
+        self.assertIsInstance(alpha.data, HStoreDict)
+        self.assertEqual(alpha.data, {'v': '1', 'v2': '3'})
+        self.assertEqual(alpha.data.changed_keys, set())
+        alpha.data['v3'] = '5'
+        alpha.save()
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '3', 'v3': '5'})
+        # saving a dictionary which was never accessed leaves it alone
+        DataBag.objects.filter(name='beta').hupdate('data', {'v3': '6'})
+        beta.name = 'gamma'
+        beta.save()
+        self.assertEqual(DataBag.objects.get(name='gamma').data, {'v': '2', 'v2': '4', 'v3': '6'})
+
+    def test_parse_hstore(self):
+        self.assertEqual(parse_hstore(''), {})
+        self.assertEqual(parse_hstore('"a"=>"1", "b"=>""'), {'a': '1', 'b': ''})
+        self.assertEqual(parse_hstore(r'"a\"b"=>NULL, "c"=>"d\\e", "NULL"=>"f"'),
+                         {'a"b': None, 'c': 'd\\e', 'NULL': 'f'})
+        self.assertRaises(ValueError, parse_hstore, 'invalid')
+
+    if tracemalloc is not None:
+        def test_shared_keys_memory(self):
+            DataBag.objects.bulk_create([
+                DataBag(name='bag%d' % i, data=dict(('key%d' % key, '1') for key in range(50)))
+                for i in range(100)
+            ])
+
+            def bytes_per_row():
+                tracemalloc.start()
+                try:
+                    bags = list(DataBag.objects.all())
+                    return tracemalloc.get_traced_memory()[0] / len(bags)
+                finally:
+                    tracemalloc.stop()
+
+            plain = bytes_per_row()
+            apps.HSTORE_SHARE_KEYS = True
+            try:
+                shared = bytes_per_row()
+            finally:
+                apps.HSTORE_SHARE_KEYS = False
+            self.assertLess(shared, plain)
+
+    def test_json_backend(self):
+        self.assertTrue(utils.get_json_backend('json') is json)
+        self.assertTrue(hasattr(utils.get_json_backend(), 'loads'))
+        with self.assertRaises(ImportError):
+            utils.get_json_backend('idontexist')
+
+    def test_copy(self):
+        bag = DataBag(data={'a': '1'})
+        d = copy.copy(bag.data)
+        self.assertEqual(d, {'a': '1'})
+        self.assertTrue(d.field is bag.data.field)
+        self.assertTrue(d.instance is bag)
+        self.assertIsNone(d.changed_keys)
+        d['b'] = '2'
+        self.assertEqual(bag.data, {'a': '1'})
+
+        # values of another HStoreDict are not checked again
+        dict.__setitem__(bag.data, 'unchecked', 1)
+        self.assertEqual(copy.copy(bag.data)['unchecked'], 1)
+        self.assertEqual(HStoreDict(bag.data)['unchecked'], 1)
+
+    def test_assign_same_dictionary(self):
+        bag = DataBag(data={'a': '1'})
+        d = bag.data
+        bag.data = d
+        self.assertTrue(bag.data is d)
+        other = DataBag(data=d)
+        self.assertFalse(other.data is d)
+        self.assertTrue(other.data.instance is other)
+        self.assertEqual(other.data, d)
+
+    def test_database_dict_not_coerced(self):
+        # values of dictionaries loaded from the database are trusted
+        d = HStoreDict(DatabaseDict({'a': 1}))
+        self.assertEqual(d['a'], 1)
+        # values set afterwards are still coerced
+        d['b'] = 2
+        self.assertEqual(d['b'], '2')
+
 
 class SchemaTests(TestCase):
     if get_django_version()[0:3] >= '1.6':
@@ -607,6 +1306,24 @@ class SchemaTests(TestCase):
             self.assertEqual(d['float'], 2.5)
             self.assertEqual(d.get('float'), 2.5)
 
+        def test_typed_values_cache(self):
+            d = SchemaDataBag().data
+
+            d['decimal'] = Decimal('1.01')
+            value = d['decimal']
+            self.assertEqual(value, Decimal('1.01'))
+            # converted only once
+            self.assertTrue(d['decimal'] is value)
+            self.assertTrue(d.get('decimal') is value)
+
+            d['decimal'] = Decimal('2.02')
+            self.assertEqual(d['decimal'], Decimal('2.02'))
+            d.update({'decimal': Decimal('3.03')})
+            self.assertEqual(d['decimal'], Decimal('3.03'))
+            del d['decimal']
+            with self.assertRaises(KeyError):
+                d['decimal']
+
         def test_dict_get(self):
             d = SchemaDataBag().data
 
@@ -891,6 +1608,33 @@ class NotTransactionalTests(SimpleTestCase):
 
             connection.close()
 
+    if django.VERSION[:2] >= (1, 6):
+        def test_stream_autocommit(self):
+            # no transaction is kept open while iterating
+            DataBag.objects.create(name='alpha', data={'v': '1'})
+            DataBag.objects.create(name='beta', data={'v': '2'})
+            try:
+                for bag in DataBag.objects.order_by('name').stream(batch_size=1):
+                    self.assertFalse(connection.in_atomic_block)
+                    self.assertEqual(connection.connection.get_transaction_status(),
+                                     psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+                    DataBag.objects.filter(pk=bag.pk).hupdate('data', {'seen': '1'})
+                self.assertEqual(DataBag.objects.filter(data__contains={'seen': '1'}).count(), 2)
+            finally:
+                DataBag.objects.all().delete()
+                connection.close()
+
+    def test_create_indexes_concurrently(self):
+        # indexes cannot be created concurrently in the transaction of a test case
+        create_indexes(CastDataBag, 'data', concurrently=True)
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE tablename = 'django_hstore_tests_castdatabag'")
+            self.assertEqual(cursor.fetchone()[0], 4)
+        finally:
+            drop_indexes(CastDataBag, 'data', concurrently=True)
+        connection.close()
+
 
 class TestReferencesField(TestCase):
     def setUp(self):
@@ -923,6 +1667,48 @@ class TestReferencesField(TestCase):
         alpha = RefsBag.objects.get(name='alpha')
         self.assertEqual(Ref.objects.get(name='0'), alpha.refs['0'])
 
+    def test_batched_retrieval(self):
+        alpha, beta, refs = self._create_bags()
+        alpha = RefsBag.objects.get(name='alpha')
+        # all the references are resolved with one query
+        with self.assertNumQueries(1):
+            self.assertEqual(alpha.refs['0'], refs[0])
+            self.assertEqual(alpha.refs['1'], refs[1])
+
+    def test_resolve(self):
+        alpha, beta, refs = self._create_bags()
+        alpha = RefsBag.objects.get(name='alpha')
+        alpha.refs['2'] = refs[2]
+        refs[1].delete()
+        with self.assertNumQueries(1):
+            alpha.refs.resolve()
+        with self.assertNumQueries(0):
+            self.assertEqual(dict(alpha.refs), {'0': refs[0], '1': None, '2': refs[2]})
+            alpha.refs.resolve()
+
+    def test_prefetch_references(self):
+        alpha, beta, refs = self._create_bags()
+        RefsBag.objects.create(name='gamma')
+        # one query for the bags, one for the referenced objects
+        with self.assertNumQueries(2):
+            bags = list(RefsBag.objects.prefetch_references('refs').order_by('name'))
+            self.assertEqual(bags[0].refs, {'0': refs[0], '1': refs[1]})
+            self.assertEqual(bags[1].refs, {'0': refs[2], '1': refs[3]})
+            self.assertEqual(bags[2].refs, {})
+        # preserved when cloning
+        qs = RefsBag.objects.prefetch_references('refs').filter(name='alpha')
+        with self.assertNumQueries(2):
+            self.assertEqual(qs[0].refs['0'], refs[0])
+        # cleared with None
+        qs = qs.prefetch_references(None)
+        with self.assertNumQueries(1):
+            bag = qs[0]
+            self.assertTrue(isinstance(dict.__getitem__(bag.refs, '0'), six.string_types))
+        # resolved for each batch when streaming
+        bags = list(RefsBag.objects.prefetch_references('refs').order_by('name').stream(batch_size=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(bags[1].refs, {'0': refs[2], '1': refs[3]})
+
     def test_simple_retrieval_get(self):
         alpha, beta, refs = self._create_bags()
         alpha = RefsBag.objects.get(name='alpha')
@@ -1036,6 +1822,44 @@ class TestReferencesField(TestCase):
             acquire_reference(None)
         with self.assertRaises(ValueError):
             acquire_reference(None)
+        with self.assertRaises(ValueError):
+            acquire_references({'0': None})
+        with self.assertRaises(ValueError):
+            acquire_references({'0': 'idontexist.Model:1'})
+        self.assertEqual(acquire_references({}), {})
+
+    def test_reference_alias(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(2)]
+        # references stored with the python path
+        bag = RefsBag.objects.create(name='bag', refs={'0': refs[0]})
+        register_reference_alias(Ref, 'ref')
+        try:
+            bag.refs['1'] = refs[1]
+            bag.save()
+            self.assertEqual(RefsBag.objects.hpeek(id=bag.id, attr='refs', key='0'), refs[0])
+            self.assertEqual(dict.__getitem__(RefsBag.objects.get(id=bag.id).refs, '1'), 'ref:%s' % refs[1].pk)
+            bag = RefsBag.objects.get(id=bag.id)
+            self.assertEqual(bag.refs.resolve(), {'0': refs[0], '1': refs[1]})
+            self.assertEqual(RefsBag.objects.filter(refs__contains={'1': refs[1]}).count(), 1)
+            with self.assertRaises(ValueError):
+                register_reference_alias(User, 'ref')
+            with self.assertRaises(ValueError):
+                register_reference_alias(Ref, 'django.ref')
+        finally:
+            del utils.reference_models['ref']
+            del utils.reference_aliases[Ref]
+
+    def test_content_type_references(self):
+        ref = Ref.objects.create(name='0')
+        utils.REFERENCES_ENCODING = 'content_type'
+        try:
+            bag = RefsBag.objects.create(name='bag', refs={'0': ref})
+        finally:
+            utils.REFERENCES_ENCODING = 'path'
+        content_type = ContentType.objects.get_for_model(Ref)
+        bag = RefsBag.objects.get(id=bag.id)
+        self.assertEqual(dict.__getitem__(bag.refs, '0'), '%s:%s' % (content_type.pk, ref.pk))
+        self.assertEqual(bag.refs['0'], ref)
 
     def test_native_contains(self):
         d = DataBag()
@@ -1121,6 +1945,21 @@ class TestReferencesField(TestCase):
         r = RefsBag()
         self.assertEqual(str(r.refs), '{}')
 
+    def test_save_changed_references_only(self):
+        alpha, beta, refs = self._create_bags()
+        alpha = RefsBag.objects.get(name='alpha')
+        # retrieving a reference is not a change
+        self.assertEqual(alpha.refs['0'], refs[0])
+        self.assertEqual(alpha.refs.changed_keys, set())
+
+        alpha.refs['2'] = refs[2]
+        del alpha.refs['1']
+        alpha.save()
+        alpha = RefsBag.objects.get(name='alpha')
+        self.assertEqual(alpha.refs['0'], refs[0])
+        self.assertEqual(alpha.refs['2'], refs[2])
+        self.assertNotIn('1', alpha.refs)
+
 
 if GEODJANGO:
     from django.contrib.gis.geos import GEOSGeometry